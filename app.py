@@ -1,43 +1,126 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, make_response, has_request_context)
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes, Blocks
+from models import db, connect_db, passwords, User, Message, Follows, Likes, Blocks, Timeline
+from pagination import (keyset_page, encode_cursor, decode_message_cursor,
+                        decode_user_cursor, decode_id_cursor,
+                        MESSAGES_PER_PAGE, USERS_PER_PAGE)
+from current_user import CurrentUser, load_snapshot, snapshot_cache
+from passwords import PasswordHasherBusy
+from metrics import Metrics
+from db_pool import pools
+from replicas import read_only
+from http_cache import (static_url, etag_for, not_modified, add_validators,
+                        cache_headers)
+from fragments import fragment_cache
+from search import (search_users, username_filter, search_messages,
+                    relevance_page, SEARCH_LIMIT)
 
 CURR_USER_KEY = "curr_user"
 
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask `g`, with `g.user` loaded on first access.
+
+    Requests that never look at the current user don't touch the database
+    for it, and the rest usually get it from the snapshot cache.
+    """
+
+    @property
+    def user(self):
+        """The logged-in user as a CurrentUser proxy, or None."""
+
+        if "_user" not in self.__dict__:
+            self._user = None
+
+            if has_request_context() and CURR_USER_KEY in session:
+                snapshot = load_snapshot(session[CURR_USER_KEY],
+                                         app.config['USER_CACHE_TTL'])
+                if snapshot:
+                    self._user = CurrentUser(snapshot)
+
+        return self._user
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# Read replicas for read-only pages (see replicas.py), as a comma-separated
+# list of URLs.
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{number}': url for number, url in enumerate(
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url)}
+app.config['DB_READ_YOUR_WRITES'] = float(os.environ.get('DB_READ_YOUR_WRITES', 5))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 16))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 5))
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING') == '1'
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_CONNECT_TIMEOUT'] = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+passwords.init_app(app)
+metrics = Metrics(app, passwords, pools)
+app.add_template_global(static_url)
+fragment_cache.init_app(app)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+@app.after_request
+def invalidate_user_snapshot(response):
+    """Drop the cached snapshot of a user after they change something.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Any POST (or PUT/DELETE to the API) may change the user's own profile
+    or counters.
+    """
 
-    else:
-        g.user = None
+    if request.method in ("POST", "PUT", "DELETE") and CURR_USER_KEY in session:
+        snapshot_cache.invalidate(session[CURR_USER_KEY])
+
+    return response
+
+
+def get_users_blocking():
+    """Ids of users blocking the current user.
+
+    Loaded at most once per request and shared by every view that needs it.
+    """
+
+    if "users_blocking" not in g:
+        g.users_blocking = Blocks.blocker_ids(g.user.id) if g.user else set()
+
+    return g.users_blocking
 
 
 def do_login(user):
@@ -104,6 +187,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -127,6 +212,7 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_only
 def list_users():
     """Page with listing of users.
 
@@ -134,22 +220,39 @@ def list_users():
     """
 
     search = request.args.get('q')
-    
-    users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
+    users, next_before = users_page(search, request.args.get('before'))
+    following_ids = (g.user.followed_among(user.id for user in users)
+                     if g.user else set())
+
+    return render_template('users/index.html', users=users, search=search,
+                           next_before=next_before, following_ids=following_ids)
 
-    if not search:
-        users = User.query.filter(User.id.notin_(users_blocking)).all()
-    else:
-        users = (User.query.filter(
-                                  User.username.like(f"%{search}%"),
-                                  User.id != g.user.id,
-                                  User.id.notin_(users_blocking))
-                                  .all())
 
-    return render_template('users/index.html', users=users)
+def users_page(search, before):
+    """One page of the user directory, newest users first.
+
+    Returns (users, next_before) where next_before is the cursor for the
+    following page, or None.
+    """
+
+    users_blocking = get_users_blocking()
+    query = User.query.filter(User.id.notin_(users_blocking))
+
+    if search:
+        query = query.filter(username_filter(search))
+
+        if g.user:
+            query = query.filter(User.id != g.user.id)
+
+    users, next_before = keyset_page(query, [User.id],
+                                     decode_user_cursor(before),
+                                     USERS_PER_PAGE)
+
+    return users, encode_cursor(next_before)
 
 
 @app.route('/users/<int:user_id>')
+@read_only
 def users_show(user_id):
     """Show user profile."""
     
@@ -159,21 +262,73 @@ def users_show(user_id):
         flash("User can't be found", "danger")
         return redirect("/")
 
+    users_blocking = get_users_blocking()
+    etag = etag_for(viewer_state(user), user_row_state(user),
+                    sorted(users_blocking), request.args.get('before'))
+    cached = not_modified(etag, user.updated_at)
+
+    if cached:
+        return cached
+
+    messages, next_before = user_messages_page(user_id,
+                                               request.args.get('before'))
+    response = make_response(render_template(
+        'users/show.html', user=user, messages=messages,
+        visible_likes=Likes.visible_count(user, users_blocking),
+        next_before=next_before))
+
+    return add_validators(response, etag, user.updated_at)
+
+
+def viewer_state(user):
+    """What a page shows that depends on who is looking at `user`.
+
+    The navbar shows the viewer, and profile/message pages show whether the
+    viewer follows or blocks `user`; their own profile shows how many
+    users they block.
+    """
+
+    if not g.user:
+        return None
+
+    if g.user.id == user.id:
+        return (g.user.id, g.user.username, g.user.image_url,
+                g.user.blocked_count())
+
+    return (g.user.id, g.user.username, g.user.image_url,
+            g.user.is_following(user), g.user.is_blocking(user))
+
+
+def user_row_state(user):
+    """The version of `user`'s row, for ETags."""
+
+    return (user.id, user.updated_at, user.messages_count, user.following_count,
+            user.followers_count, user.likes_count)
+
+
+def user_messages_page(user_id, before):
+    """One page of a user's messages, newest first.
+
+    Returns (messages, next_before) where next_before is the cursor for the
+    following page, or None.
+    """
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
-    likes = [message for message in user.likes if message.user_id not in users_blocking]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    messages, next_before = keyset_page(
+        (Message
+         .query
+         .filter(Message.user_id == user_id)
+         .options(db.joinedload(Message.user))),
+        [Message.timestamp, Message.id],
+        decode_message_cursor(before),
+        MESSAGES_PER_PAGE)
+
+    return messages, encode_cursor(next_before)
 
 
 @app.route('/users/<int:user_id>/following')
+@read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -182,12 +337,17 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
-    likes = [message for message in user.likes if message.user_id not in users_blocking]
-    return render_template('users/following.html', user=user, likes=likes)
+    users, next_before = related_users_page(
+        Follows, Follows.user_being_followed_id, Follows.user_following_id,
+        user_id, request.args.get('before'))
+    following_ids = g.user.followed_among(followed_user.id for followed_user in users)
+    return render_template('users/following.html', user=user, users=users,
+                           visible_likes=Likes.visible_count(user, get_users_blocking()),
+                           following_ids=following_ids, next_before=next_before)
 
 
 @app.route('/users/<int:user_id>/followers')
+@read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -196,9 +356,37 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
-    likes = [message for message in user.likes if message.user_id not in users_blocking]
-    return render_template('users/followers.html', user=user, likes=likes)
+    users, next_before = related_users_page(
+        Follows, Follows.user_following_id, Follows.user_being_followed_id,
+        user_id, request.args.get('before'))
+    following_ids = g.user.followed_among(follower.id for follower in users)
+    return render_template('users/followers.html', user=user, users=users,
+                           visible_likes=Likes.visible_count(user, get_users_blocking()),
+                           following_ids=following_ids, next_before=next_before)
+
+
+def related_users_page(model, related_id, owner_id, user_id, before):
+    """One page of the users related to `user_id` by a follows/blocks row.
+
+    `model` is Follows or Blocks, `owner_id` its column holding `user_id`
+    and `related_id` the column holding the users to list; e.g. who
+    user 1 follows:
+
+        related_users_page(Follows, Follows.user_being_followed_id,
+                           Follows.user_following_id, 1, before)
+
+    Pages are keyset on `related_id`, read in order off the index on
+    (owner_id, related_id). Returns (users, next_before).
+    """
+
+    users, next_before = keyset_page(
+        User.query.join(model, related_id == User.id).filter(owner_id == user_id),
+        [related_id],
+        decode_id_cursor(before),
+        USERS_PER_PAGE,
+        key=lambda user: (user.id,))
+
+    return users, encode_cursor(next_before)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -209,7 +397,7 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    g.user.following.append(followed_user)
+    g.user.follow(follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -223,14 +411,15 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    User.query.get_or_404(follow_id)
+    g.user.unfollow(follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/<int:user_id>/blocked-users')
+@read_only
 def block_user(user_id):
     """ Block/unblock users from following/commenting/liking another user's posts"""
 
@@ -239,9 +428,13 @@ def block_user(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
-    likes = [message for message in user.likes if message.user_id not in users_blocking]
-    return render_template('users/blocked-users.html', user=user, likes=likes)
+    users, next_before = related_users_page(
+        Blocks, Blocks.user_being_blocked_id, Blocks.user_blocking_id,
+        user_id, request.args.get('before'))
+    blocked_ids = g.user.blocked_among(blocked_user.id for blocked_user in users)
+    return render_template('users/blocked-users.html', user=user, users=users,
+                           visible_likes=Likes.visible_count(user, get_users_blocking()),
+                           blocked_ids=blocked_ids, next_before=next_before)
 
 
 @app.route('/users/block/<int:block_id>', methods=['POST'])
@@ -251,16 +444,8 @@ def add_block(block_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    blocked_user = User.query.get_or_404(block_id)
-    g.user.blocked_users.append(blocked_user)
-
-    if g.user.is_following(blocked_user):
-        g.user.following.remove(blocked_user)
-    
-    if blocked_user.is_following(g.user):
-        blocked_user.following.remove(g.user)
-
-
+    User.query.get_or_404(block_id)
+    g.user.block(block_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/blocked-users")
@@ -274,8 +459,8 @@ def stop_blocking(block_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    blocked_user = User.query.get_or_404(block_id)
-    g.user.blocked_users.remove(blocked_user)
+    User.query.get_or_404(block_id)
+    g.user.unblock(block_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/blocked-users")
@@ -321,9 +506,22 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_id = g.user.id
     do_logout()
-
-    db.session.delete(g.user)
+    snapshot_cache.invalidate(user_id)
+
+    # Everyone whose counters include this user: followers, followed users
+    # and users who liked one of this user's messages.
+    affected_ids = {follow.user_following_id for follow in Follows.query.filter(
+                        Follows.user_being_followed_id == g.user.id)}
+    affected_ids |= {follow.user_being_followed_id for follow in Follows.query.filter(
+                        Follows.user_following_id == g.user.id)}
+    affected_ids |= {like.user_id for like in Likes.query.join(Message).filter(
+                        Message.user_id == g.user.id)}
+
+    db.session.delete(g.user._get_current_object())
+    db.session.flush()
+    User.recount(affected_ids)
     db.session.commit()
 
     return redirect("/signup")
@@ -348,6 +546,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        Timeline.fan_out(msg)
+        User.adjust_counts([g.user.id], messages_count=1)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -355,19 +556,77 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@read_only
+def messages_search():
+    """Search messages by text.
+
+    Takes 'q', and 'sort' of 'recent' (default; older results through the
+    'before' cursor) or 'relevance' (through 'page').
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    search = request.args.get('q', '')
+    sort = request.args.get('sort', 'recent')
+    messages, next_page = message_search_page(search, sort)
+
+    return render_template('messages/search.html', messages=messages,
+                           search=search, sort=sort, next_page=next_page)
+
+
+def message_search_page(search, sort):
+    """One page of message search results for the current user.
+
+    Messages by users blocking the viewer are left out. Returns
+    (messages, next_page) where next_page is the 'before' cursor or 'page'
+    number of the following page, depending on `sort`, or None.
+    """
+
+    if not search:
+        return [], None
+
+    query = search_messages(search, exclude_user_ids=get_users_blocking())
+
+    if sort == 'relevance':
+        return relevance_page(query, search,
+                              request.args.get('page', 1, type=int),
+                              MESSAGES_PER_PAGE)
+
+    messages, next_before = keyset_page(query,
+                                        [Message.timestamp, Message.id],
+                                        decode_message_cursor(request.args.get('before')),
+                                        MESSAGES_PER_PAGE)
+
+    return messages, encode_cursor(next_before)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    user = User.query.get_or_404(msg.user_id)
+    msg = Message.query.get_or_404(message_id)
+    user = msg.user
     
     if (user.is_blocking(g.user)):
         flash("Message can't be found", "danger")
         return redirect("/")
 
+    # The page shows the message's text and date, which aren't editable,
+    # its author and whether the viewer follows them; no likes. So the
+    # author's row and the viewer are all that can make it differ.
+    etag = etag_for(viewer_state(user), user_row_state(user), msg.id)
+    last_modified = max(msg.timestamp, user.updated_at)
+    cached = not_modified(etag, last_modified)
+
+    if cached:
+        return cached
 
-    return render_template('messages/show.html', message=msg)
+    response = make_response(render_template('messages/show.html', message=msg))
+    return add_validators(response, etag, last_modified)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -379,7 +638,11 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    liker_ids = [like.user_id for like in Likes.query.filter(
+                     Likes.message_id == message_id)]
     db.session.delete(msg)
+    User.adjust_counts([g.user.id], messages_count=-1)
+    User.adjust_counts(liker_ids, likes_count=-1)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
@@ -392,22 +655,16 @@ def likes_add(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    existing_like = Likes.query.filter(
-                                    Likes.user_id == g.user.id,
-                                    Likes.message_id == msg_id).first()
+    if not g.user.unlike(msg_id):
+        g.user.like(msg_id)
 
-    if existing_like:
-        db.session.delete(existing_like)
-    else:
-        like = Likes(user_id=g.user.id, message_id=msg_id)
-        db.session.add(like)
-    
     db.session.commit()
 
     return redirect("/")
 
 
 @app.route('/users/<int:user_id>/likes')
+@read_only
 def users_likes(user_id):
     """Show list of likes for this user."""
 
@@ -415,11 +672,31 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
-    # likes = Message.query.filter(Message.user_id.notin_(users_blocking)).all()
+    users_blocking = get_users_blocking()
     user = User.query.get_or_404(user_id)
-    likes = [message for message in user.likes if message.user_id not in users_blocking]
-    return render_template('users/likes.html', user=user, likes=likes)
+    likes, next_before = liked_messages_page(user_id, users_blocking,
+                                             request.args.get('before'))
+    liked_ids = g.user.liked_among(message.id for message in likes)
+    return render_template('users/likes.html', user=user, likes=likes,
+                           visible_likes=Likes.visible_count(user, users_blocking),
+                           liked_ids=liked_ids, next_before=next_before)
+
+
+def liked_messages_page(user_id, hidden_author_ids, before):
+    """One page of the messages a user likes, most recent messages first.
+
+    Returns (messages, next_before) where next_before is the cursor for the
+    following page, or None.
+    """
+
+    messages, next_before = keyset_page(
+        Likes.liked_messages(user_id, hidden_author_ids),
+        [Likes.message_id],
+        decode_id_cursor(before),
+        MESSAGES_PER_PAGE,
+        key=lambda message: (message.id,))
+
+    return messages, encode_cursor(next_before)
 
 
 ##############################################################################
@@ -427,45 +704,272 @@ def users_likes(user_id):
 
 
 @app.route('/')
+@read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from the
+      user's precomputed timeline; older pages via the 'before' param
     """
 
     if g.user:
-        users_blocking = [block.user_blocking_id for block in Blocks.query.all() if block.user_being_blocked_id == g.user.id]
-
-        following_user_ids = [user.id for user in g.user.following] 
-        following_user_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_user_ids),
-                            Message.user_id.notin_(users_blocking))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        liked_messages = [message.id for message in g.user.likes]
-        return render_template('home.html', messages=messages, liked_messages=liked_messages)
+        messages, next_before = timeline_page(g.user.id,
+                                              request.args.get('before'))
+        liked_messages = g.user.liked_among(message.id for message in messages)
+        return render_template('home.html', messages=messages, liked_messages=liked_messages,
+                               next_before=next_before)
 
     else:
         return render_template('home-anon.html')
 
 
+def timeline_page(user_id, before):
+    """One page of a user's home timeline, newest first.
+
+    Returns (messages, next_before) where next_before is the cursor for the
+    following page, or None.
+    """
+
+    messages, next_before = keyset_page(
+        Timeline.feed_query(user_id),
+        [Timeline.timestamp, Timeline.message_id],
+        decode_message_cursor(before),
+        MESSAGES_PER_PAGE,
+        key=lambda message: (message.timestamp, message.id))
+
+    return messages, encode_cursor(next_before)
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# JSON API routes
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+
+@app.route('/api/timeline')
+@read_only
+def api_timeline():
+    """JSON page of the current user's home timeline.
+
+    Returns {"messages": [...], "next": cursor-or-null}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages, next_before = timeline_page(g.user.id, request.args.get('before'))
+
+    return jsonify(messages=[message.serialize() for message in messages],
+                   next=next_before)
+
+
+@app.route('/api/users')
+@read_only
+def api_list_users():
+    """JSON page of the user directory; takes the same 'q' as /users.
+
+    Returns {"users": [...], "next": cursor-or-null}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    users, next_before = users_page(request.args.get('q'),
+                                    request.args.get('before'))
+
+    return jsonify(users=[user.serialize() for user in users],
+                   next=next_before)
+
+
+@app.route('/api/users/search')
+@read_only
+def api_search_users():
+    """JSON user search, best matches first.
+
+    Takes 'q', plus optional 'prefix' (match start of username only, for
+    typeahead) and 'limit'. Returns {"users": [...]}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    search = request.args.get('q', '')
+
+    if not search:
+        return jsonify(users=[])
+
+    users = search_users(search,
+                         limit=request.args.get('limit', SEARCH_LIMIT, type=int),
+                         prefix=bool(request.args.get('prefix')),
+                         exclude_ids=get_users_blocking() | {g.user.id})
+
+    return jsonify(users=[user.serialize() for user in users])
+
+
+@app.route('/api/messages/search')
+@read_only
+def api_search_messages():
+    """JSON message search; takes the same params as /messages/search.
+
+    Returns {"messages": [...], "next": cursor-or-page-or-null}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages, next_page = message_search_page(request.args.get('q', ''),
+                                              request.args.get('sort', 'recent'))
+
+    return jsonify(messages=[message.serialize() for message in messages],
+                   next=next_page)
+
+
+@app.route('/api/users/<int:user_id>/messages')
+@read_only
+def api_user_messages(user_id):
+    """JSON page of a user's messages.
+
+    Returns {"messages": [...], "next": cursor-or-null}.
+    """
+
+    user = User.query.get_or_404(user_id)
+
+    if user.is_blocking(g.user):
+        return jsonify(error="User can't be found"), 404
+
+    messages, next_before = user_messages_page(user_id,
+                                               request.args.get('before'))
+
+    return jsonify(messages=[message.serialize() for message in messages],
+                   next=next_before)
+
+
+# Like/follow/block toggles for static/main.js. PUT sets the state and DELETE
+# clears it; both are idempotent, so retries and double clicks are harmless.
+# Cross-site pages can't send PUT or DELETE without a CORS preflight, which
+# keeps them out.
+
+@app.route('/api/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def api_like(message_id):
+    """Like (PUT) or unlike (DELETE) a message.
+
+    Returns {"liked": bool, "likes_count": the current user's like count}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    message = Message.query.get_or_404(message_id)
+
+    if message.user_id == g.user.id:
+        return jsonify(error="You can't like your own message."), 403
+
+    if request.method == 'PUT':
+        g.user.like(message_id)
+    else:
+        g.user.unlike(message_id)
+
+    db.session.commit()
+
+    likes_count = (db.session
+                   .query(User.likes_count)
+                   .filter(User.id == g.user.id)
+                   .scalar())
+
+    return jsonify(liked=request.method == 'PUT', likes_count=likes_count)
+
+
+@app.route('/api/users/<int:user_id>/follow', methods=['PUT', 'DELETE'])
+def api_follow(user_id):
+    """Follow (PUT) or unfollow (DELETE) a user.
+
+    Returns {"following": bool, "user": counts, "me": counts}, where counts
+    are the followers_count/following_count of that user and of the
+    current user.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    user = User.query.get_or_404(user_id)
+
+    if request.method == 'PUT':
+        if user_id == g.user.id or user.is_blocking(g.user):
+            return jsonify(error="Access unauthorized."), 403
+
+        g.user.follow(user_id)
+    else:
+        g.user.unfollow(user_id)
+
+    db.session.commit()
+
+    return jsonify(following=request.method == 'PUT',
+                   **follow_counts(user_id))
+
+
+@app.route('/api/users/<int:user_id>/block', methods=['PUT', 'DELETE'])
+def api_block(user_id):
+    """Block (PUT) or unblock (DELETE) a user.
+
+    Blocking also ends any follows between the two users. Returns
+    {"blocking": bool, "following": bool, "user": counts, "me": counts}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    User.query.get_or_404(user_id)
+
+    if request.method == 'PUT':
+        if user_id == g.user.id:
+            return jsonify(error="Access unauthorized."), 403
+
+        g.user.block(user_id)
+    else:
+        g.user.unblock(user_id)
+
+    db.session.commit()
+
+    return jsonify(blocking=request.method == 'PUT',
+                   following=g.user.followed_among([user_id]) == {user_id},
+                   **follow_counts(user_id))
+
+
+def follow_counts(user_id):
+    """Follower/following counts of `user_id` and the current user."""
+
+    rows = (db.session
+            .query(User.id, User.followers_count, User.following_count)
+            .filter(User.id.in_([user_id, g.user.id])))
+
+    counts = {row.id: {"followers_count": row.followers_count,
+                       "following_count": row.following_count}
+              for row in rows}
+
+    return {"user": counts[user_id], "me": counts[g.user.id]}
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Shed load when too many password hashes are already waiting."""
+
+    return "Too many sign-ins right now, please try again shortly.", 503, {
+        "Retry-After": "5"}
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('recount-stats')
+def recount_stats():
+    """Recompute every user's message/follow/like counters."""
+
+    User.recount()
+    db.session.commit()
+
+
+##############################################################################
+# HTTP caching: long-lived versioned static files; pages must revalidate
+# (see http_cache.py)
+
+app.after_request(cache_headers)
@@ -0,0 +1,441 @@
+"""Benchmark Warbler's hot routes.
+
+Seeds a dataset of the requested size through generator/create_csvs.py and
+seed.py, then drives each route in ROUTES:
+
+- in process with the Flask test client, counting SQL statements, and
+- over HTTP against a local gunicorn, with --concurrency client threads.
+
+Latency percentiles, throughput and queries per request are printed per
+route, along with responses that failed (status 400 and up), and compared
+with a stored baseline; any regression beyond --tolerance (or any extra
+query or error) makes the run exit non-zero.
+
+    createdb warbler-bench
+    DATABASE_URL=postgres:///warbler-bench python benchmark.py --save-baseline
+    ... change things ...
+    DATABASE_URL=postgres:///warbler-bench python benchmark.py
+
+Use --skip-seed to rerun against the data already in the database, and
+--route to time only some routes. gunicorn runs with gunicorn.conf.py,
+overridden by --gunicorn-args; --db-latency adds a wait before every SQL
+statement, to mimic a database on another host when the local one answers
+instantly. Numbers are only comparable between runs with the same dataset,
+mode, settings and machine.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+os.environ.setdefault('DATABASE_URL', 'postgres:///warbler-bench')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmark-baseline.json')
+
+# (method, path, form data); {viewer}, {target} and {message} are filled in
+# by pick_ids().
+ROUTES = [
+    ('GET', '/', None),
+    ('GET', '/users', None),
+    ('GET', '/users/{target}', None),
+    ('GET', '/users/{target}/likes', None),
+    ('POST', '/messages/new', {'text': 'Benchmarking, please ignore.'}),
+    ('POST', '/likes/{message}/update', None),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+##############################################################################
+# Dataset
+
+
+def seed(opts):
+    """Generate CSVs of the requested size and load them with seed.py."""
+
+    with tempfile.TemporaryDirectory() as csv_dir:
+        subprocess.run(
+            [sys.executable, 'create_csvs.py',
+             '--users', str(opts.users), '--messages', str(opts.messages),
+             '--follows', str(opts.follows), '--likes', str(opts.likes),
+             '--blocks', str(opts.blocks), '--seed', opts.seed,
+             '--workers', str(opts.workers), '--shards', str(opts.workers),
+             '--out', csv_dir],
+            cwd=os.path.join(HERE, 'generator'), check=True,
+            stdout=subprocess.DEVNULL)
+
+        subprocess.run([sys.executable, 'seed.py', csv_dir],
+                       cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+
+
+def pick_ids():
+    """Ids to benchmark with, chosen to make the pages heavy.
+
+    viewer: the user following the most people (largest timeline),
+    target: the most followed user,
+    message: the newest message the viewer didn't write.
+    """
+
+    from models import User, Message
+
+    viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+    target = User.query.order_by(User.followers_count.desc(), User.id).first()
+    message = (Message.query
+               .filter(Message.user_id != viewer.id)
+               .order_by(Message.timestamp.desc(), Message.id.desc())
+               .first())
+
+    return {'viewer': viewer.id, 'target': target.id, 'message': message.id}
+
+
+def session_cookie(app, user_id):
+    """A signed session cookie logging in `user_id`, and its CSRF token."""
+
+    from flask import session
+    from flask_wtf.csrf import generate_csrf
+
+    from app import CURR_USER_KEY
+
+    with app.test_request_context():
+        session[CURR_USER_KEY] = user_id
+        csrf_token = generate_csrf()
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = serializer.dumps(dict(session))
+
+    return cookie, csrf_token
+
+
+##############################################################################
+# Measurements
+
+
+def selected_routes(opts):
+    """ROUTES, or just those named with --route (e.g. "GET /users/{target}")."""
+
+    if not opts.route:
+        return ROUTES
+
+    return [route for route in ROUTES if f'{route[0]} {route[1]}' in opts.route]
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a non-empty, sorted list."""
+
+    rank = max(int(round(pct / 100 * len(samples))), 1)
+    return samples[rank - 1]
+
+
+def summarize(samples, elapsed, queries=None):
+    """Stats for one route from its (latency in seconds, status) samples."""
+
+    latencies = sorted(latency for latency, _ in samples)
+    stats = {f'p{pct}_ms': round(percentile(latencies, pct) * 1000, 2)
+             for pct in PERCENTILES}
+    stats['max_ms'] = round(latencies[-1] * 1000, 2)
+    stats['throughput_rps'] = round(len(latencies) / elapsed, 1)
+    stats['errors'] = sum(status >= 400 for _, status in samples)
+
+    if queries is not None:
+        stats['queries_per_request'] = round(queries / len(latencies), 1)
+
+    return stats
+
+
+def form_body(data, csrf_token):
+    return urlencode(dict(data, csrf_token=csrf_token)) if data else ''
+
+
+def run_client(app, ids, opts):
+    """Drive each route through the Flask test client, one at a time.
+
+    No app context is pushed around the requests: each one gets its own,
+    as under a real server, so `g` and the SQLAlchemy session don't carry
+    over from one request to the next and hide queries.
+    """
+
+    from models import db
+    from query_counter import QueryCounter
+
+    with app.app_context():
+        engine = db.engine
+
+    cookie, csrf_token = session_cookie(app, ids['viewer'])
+    client = app.test_client()
+    client.set_cookie('localhost', app.session_cookie_name, cookie)
+    results = {}
+
+    for method, path, data in selected_routes(opts):
+        url = path.format(**ids)
+        body = form_body(data, csrf_token)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        def request():
+            before = time.perf_counter()
+            response = client.open(url, method=method, data=body, headers=headers)
+            return time.perf_counter() - before, response.status_code
+
+        for _ in range(opts.warmup):
+            request()
+
+        with QueryCounter(engine) as counter:
+            start = time.perf_counter()
+            samples = [request() for _ in range(opts.requests)]
+            elapsed = time.perf_counter() - start
+
+        results[f'{method} {path}'] = summarize(samples, elapsed, counter.count)
+
+    return results
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f"gunicorn didn't start listening on port {port}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def simulate_db_latency(milliseconds):
+    """Wait `milliseconds` before every SQL statement in this process.
+
+    Stands in for the network round trip (and server time) of a database
+    on another host, when benchmarking against a local one: that's the
+    wait that threaded workers overlap.
+    """
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    def wait(*args):
+        time.sleep(milliseconds / 1000)
+
+    event.listen(Engine, 'before_cursor_execute', wait)
+
+
+def latency_app(milliseconds):
+    """The app with simulated database latency, for gunicorn."""
+
+    from app import app
+
+    simulate_db_latency(milliseconds)
+    return app
+
+
+def run_gunicorn(app, ids, opts):
+    """Drive each route over HTTP against a local gunicorn."""
+
+    target = (f'benchmark:latency_app({opts.db_latency})' if opts.db_latency
+              else 'app:app')
+    port = free_port()
+    server = subprocess.Popen(
+        ['gunicorn', target,
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning']
+        + opts.gunicorn_args.split(),
+        cwd=HERE)
+
+    try:
+        wait_for_port(port)
+        return drive_http(port, app, ids, opts)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def drive_http(port, app, ids, opts):
+    cookie, csrf_token = session_cookie(app, ids['viewer'])
+    results = {}
+
+    for method, path, data in selected_routes(opts):
+        url = path.format(**ids)
+        body = form_body(data, csrf_token)
+        headers = {'Cookie': f'{app.session_cookie_name}={cookie}',
+                   'Content-Type': 'application/x-www-form-urlencoded'}
+
+        def request(_=None):
+            # Redirects aren't followed: only the route itself is timed.
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            before = time.perf_counter()
+
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            finally:
+                connection.close()
+
+            return time.perf_counter() - before, response.status
+
+        for _ in range(opts.warmup):
+            request()
+
+        with ThreadPoolExecutor(opts.concurrency) as pool:
+            start = time.perf_counter()
+            samples = list(pool.map(request, range(opts.requests)))
+            elapsed = time.perf_counter() - start
+
+        results[f'{method} {path}'] = summarize(samples, elapsed)
+
+    return results
+
+
+##############################################################################
+# Baselines
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of `results` against `baseline`, as readable strings.
+
+    Latencies may grow and throughput may drop by `tolerance` (a fraction)
+    before counting as a regression; query and error counts may not grow
+    at all.
+    """
+
+    regressions = []
+
+    for mode, routes in results.items():
+        for route, stats in routes.items():
+            base = baseline.get(mode, {}).get(route)
+
+            if base is None:
+                continue
+
+            for field, value in stats.items():
+                if field not in base:
+                    continue
+
+                if field in ('queries_per_request', 'errors'):
+                    worse = value > base[field]
+                elif field == 'throughput_rps':
+                    worse = value < base[field] * (1 - tolerance)
+                else:
+                    worse = value > base[field] * (1 + tolerance)
+
+                if worse:
+                    regressions.append(
+                        f"{mode} {route} {field}: {base[field]} -> {value}")
+
+    return regressions
+
+
+def print_results(results, out=sys.stdout):
+    for mode, routes in results.items():
+        print(f"\n[{mode}]", file=out)
+
+        for route, stats in routes.items():
+            line = "  ".join(f"{field}={value}" for field, value in stats.items())
+            print(f"{route:32} {line}", file=out)
+
+
+##############################################################################
+# Command line
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    dataset = parser.add_argument_group('dataset')
+    dataset.add_argument('--users', type=int, default=10000)
+    dataset.add_argument('--messages', type=int, default=100000)
+    dataset.add_argument('--follows', type=int, default=500000)
+    dataset.add_argument('--likes', type=int, default=200000)
+    dataset.add_argument('--blocks', type=int, default=5000)
+    dataset.add_argument('--seed', default='warbler')
+    dataset.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                         help="generator processes")
+    dataset.add_argument('--skip-seed', action='store_true',
+                         help="benchmark the data already in the database")
+
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'both'],
+                        default='both')
+    parser.add_argument('--route', action='append',
+                        help="only benchmark this route, e.g. 'GET /' (repeatable)")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="timed requests per route")
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="untimed requests per route first")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="client threads for the gunicorn run")
+    parser.add_argument('--gunicorn-args', default='',
+                        help="gunicorn arguments overriding gunicorn.conf.py")
+    parser.add_argument('--db-latency', type=float, default=0,
+                        help="milliseconds to wait before each SQL statement, "
+                             "to mimic a database on another host")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--output', help="also write results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+
+    if not opts.skip_seed:
+        seed(opts)
+
+    # Imported after seeding: seed.py drops and recreates the tables.
+    from app import app
+
+    with app.app_context():
+        ids = pick_ids()
+
+    results = {}
+
+    if opts.mode in ('client', 'both'):
+        if opts.db_latency:
+            simulate_db_latency(opts.db_latency)
+
+        results['client'] = run_client(app, ids, opts)
+
+    if opts.mode in ('gunicorn', 'both'):
+        results['gunicorn'] = run_gunicorn(app, ids, opts)
+
+    print_results(results)
+
+    if opts.output:
+        with open(opts.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if opts.save_baseline:
+        with open(opts.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"\nsaved baseline to {opts.baseline}")
+        return
+
+    if not os.path.exists(opts.baseline):
+        print(f"\nno baseline at {opts.baseline}; run with --save-baseline")
+        return
+
+    with open(opts.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), opts.tolerance)
+
+    if regressions:
+        print("\nREGRESSIONS:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+    print("\nno regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Lazily loaded, cached current user for Warbler.
+
+Most pages only need a handful of the current user's columns (for the
+navbar and the home page card), and many requests (redirects, POSTs that
+fail validation) never look at the user at all. So instead of loading a
+full User row before every request:
+
+- `g.user` is computed on first access (see WarblerGlobals in app.py),
+- from a compact UserSnapshot kept in a small, short-lived LRU cache,
+- and wrapped in a CurrentUser proxy that answers snapshot fields from the
+  snapshot and only loads the full User row when something else (a
+  relationship, a column not in the snapshot, an assignment) is touched.
+
+The cache is per process, so a snapshot may be up to USER_CACHE_TTL
+seconds stale in other workers; the current process drops a user's
+snapshot whenever they change it.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from models import db, User
+
+SNAPSHOT_FIELDS = ('id', 'username', 'image_url', 'header_image_url',
+                   'messages_count', 'following_count', 'followers_count',
+                   'likes_count')
+
+UserSnapshot = namedtuple('UserSnapshot', SNAPSHOT_FIELDS)
+
+# User methods that only read `self.id`, so the proxy can run them without
+# loading the full row.
+ID_ONLY_METHODS = ('is_following', 'is_followed_by', 'is_blocking',
+                   'followed_among', 'blocked_among', 'liked_among',
+                   'blocked_count',
+                   'follow', 'unfollow', 'like', 'unlike', 'block', 'unblock')
+
+
+class SnapshotCache:
+    """Thread-safe LRU cache of UserSnapshots with a time-to-live."""
+
+    def __init__(self, max_size=1024, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Cached snapshot for `user_id`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is None:
+                return None
+
+            snapshot, expires = entry
+
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, snapshot, ttl=None):
+        """Cache `snapshot` for `ttl` seconds (default: self.ttl; 0: don't)."""
+
+        ttl = self.ttl if ttl is None else ttl
+
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[snapshot.id] = (snapshot, time.monotonic() + ttl)
+            self._entries.move_to_end(snapshot.id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+snapshot_cache = SnapshotCache()
+
+
+def load_snapshot(user_id, ttl=None):
+    """Snapshot of `user_id` from the cache, else from the database.
+
+    A snapshot read from the database is cached for `ttl` seconds (default:
+    the cache's own). Returns None if there is no such user.
+    """
+
+    snapshot = snapshot_cache.get(user_id)
+
+    if snapshot is None:
+        row = (db.session
+               .query(*[getattr(User, field) for field in SNAPSHOT_FIELDS])
+               .filter(User.id == user_id)
+               .first())
+
+        if row is None:
+            return None
+
+        snapshot = UserSnapshot(*row)
+        snapshot_cache.put(snapshot, ttl)
+
+    return snapshot
+
+
+class CurrentUser:
+    """Proxy for the logged-in User, backed by a UserSnapshot.
+
+    Behaves like the User for reading and writing attributes and calling
+    methods. Use `_get_current_object()` where a real User instance is
+    required, e.g. `db.session.delete(...)` or adding to a relationship.
+    """
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', None)
+
+    def _get_current_object(self):
+        """The full User row, loaded on first use."""
+
+        if self._user is None:
+            object.__setattr__(self, '_user', User.query.get(self._snapshot.id))
+
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None:
+            if name in SNAPSHOT_FIELDS:
+                return getattr(self._snapshot, name)
+
+            if name in ID_ONLY_METHODS:
+                return getattr(User, name).__get__(self)
+
+        return getattr(self._get_current_object(), name)
+
+    def __setattr__(self, name, value):
+        snapshot_cache.invalidate(self._snapshot.id)
+        setattr(self._get_current_object(), name, value)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self._snapshot.id
+
+    def __hash__(self):
+        return hash(self._snapshot.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot.id}: {self._snapshot.username}>"
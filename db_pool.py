@@ -0,0 +1,212 @@
+"""Database connection pooling for Warbler.
+
+Each process keeps a pool of PostgreSQL connections, sized and aged by
+the settings below, and watched: how long requests wait to check a
+connection out, how often they give up, and how full the pool is. The
+numbers go to /metrics (see metrics.py) and each checkout sends the
+`checkout_finished` signal with the seconds it waited, for Server-Timing.
+
+Configuration (app.config, set from the environment in app.py):
+
+- DB_POOL_SIZE: connections each process keeps open.
+- DB_MAX_OVERFLOW: extra connections opened under load, closed on return.
+- DB_POOL_TIMEOUT: seconds to wait for a free connection before failing.
+- DB_POOL_RECYCLE: seconds after which a connection is replaced, so none
+  outlive the server's or a proxy's idle timeout.
+- DB_POOL_PRE_PING: test each connection as it's checked out, so ones
+  broken by a failover are replaced instead of failing the request.
+- DB_CONNECT_TIMEOUT: seconds to wait for a new connection to open.
+- DB_STATEMENT_TIMEOUT: milliseconds after which PostgreSQL cancels a
+  statement; 0 for no limit.
+
+Every gunicorn worker has its own pool: workers x (size + overflow) must
+stay below the server's max_connections.
+
+A connection opened before fork() must not be used by both processes, so
+gunicorn.conf.py closes the master's connections before forking workers
+(dispose_all), and each worker starts with an empty pool
+(reset_after_fork). As a last guard, a pool never hands out a connection
+opened by another process.
+
+Settings apply to PostgreSQL only; SQLite keeps Flask-SQLAlchemy's pool.
+"""
+
+import os
+import threading
+import time
+import weakref
+
+import flask_sqlalchemy
+from blinker import Namespace
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+_signals = Namespace()
+
+checkout_finished = _signals.signal('db-checkout-finished')
+
+# Connections inherited over fork() are dropped from the pool but kept
+# referenced here: garbage collecting one would close it, ending the
+# session the other process is still using.
+_inherited = []
+
+
+class MonitoredQueuePool(QueuePool):
+    """QueuePool that counts checkouts, waits and timeouts."""
+
+    name = "default"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pid = os.getpid()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._stats_lock = threading.Lock()
+        pools.add(self)
+
+        event.listen(self, 'connect', _remember_pid)
+        event.listen(self, 'checkout', _refuse_other_pid)
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+            checkout_finished.send(self, seconds=waited)
+
+    def capacity(self):
+        return self.size() + max(self._max_overflow, 0)
+
+    def stats(self):
+        """Snapshot of this pool's counters, for metrics."""
+
+        checked_out = self.checkedout()
+        capacity = self.capacity()
+
+        return {
+            "pool": self.name,
+            "size": self.size(),
+            "capacity": capacity,
+            "checked_out": checked_out,
+            "saturation": checked_out / capacity if capacity else 0.0,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _refuse_other_pid(dbapi_connection, connection_record, connection_proxy):
+    # A connection inherited over fork(): drop it without closing it and
+    # make the pool open a fresh one.
+    if connection_record.info.get('pid') != os.getpid():
+        _inherited.append(dbapi_connection)
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "connection belongs to another process; reconnecting")
+
+
+class PoolRegistry:
+    """The MonitoredQueuePools of this process."""
+
+    def __init__(self):
+        self._pools = weakref.WeakSet()
+
+    def add(self, pool):
+        self._pools.add(pool)
+
+    def __iter__(self):
+        return iter([pool for pool in list(self._pools)
+                     if pool.pid == os.getpid()])
+
+    def stats(self):
+        """Snapshot of every pool's counters, for metrics."""
+
+        return [pool.stats() for pool in sorted(self, key=lambda pool: pool.name)]
+
+    def dispose_all(self):
+        """Close every idle connection; call in the master before fork()."""
+
+        for pool in self:
+            pool.dispose()
+
+    def reset_after_fork(self):
+        """Start this (forked) process's pools empty, with fresh counters.
+
+        The inherited connections are dropped without being closed: they
+        belong to the parent.
+        """
+
+        for pool in list(self._pools):
+            if pool.pid == os.getpid():
+                continue
+
+            _inherited.extend(pool._pool.queue)
+            pool._pool.queue.clear()
+            pool._overflow = 0 - pool.size()
+            pool.pid = os.getpid()
+            pool.checkouts = pool.timeouts = 0
+            pool.wait_seconds = pool.max_wait_seconds = 0.0
+            pool._stats_lock = threading.Lock()
+
+
+pools = PoolRegistry()
+
+
+def monitored_pool(name):
+    """A MonitoredQueuePool class whose pools report as `name`."""
+
+    return type('MonitoredQueuePool', (MonitoredQueuePool,), {'name': name})
+
+
+def engine_options(config, url):
+    """create_engine() keyword arguments for `url` from the DB_* settings."""
+
+    connect_args = {}
+
+    if config.get('DB_CONNECT_TIMEOUT'):
+        connect_args['connect_timeout'] = int(config['DB_CONNECT_TIMEOUT'])
+
+    if config.get('DB_STATEMENT_TIMEOUT'):
+        connect_args['options'] = (
+            f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT'])}")
+
+    return {
+        'poolclass': monitored_pool(f"{url.host or 'localhost'}/{url.database}"),
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', -1),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', False),
+        'connect_args': connect_args,
+    }
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """Flask-SQLAlchemy, with PostgreSQL engines pooled per the DB_* settings."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super().apply_driver_hacks(app, sa_url, options)
+
+        if sa_url.drivername.startswith('postgres'):
+            options.update(engine_options(app.config, sa_url))
+
+        return result
@@ -0,0 +1,140 @@
+"""Cache rendered HTML fragments that look the same for every viewer.
+
+A timeline shows the same message cards to many viewers, and a profile
+header is the same for everyone but a couple of buttons. Templates render
+such fragments through `cached_fragment`, with a key made of whatever the
+fragment shows (ids and row versions):
+
+    {% from 'fragments.html' import message_card %}
+    {{ cached_fragment('message', [msg.id, msg.timestamp], message_card, msg)
+       | fill(like=like_button) }}
+
+The macro only runs on a miss. Bits that depend on the viewer are left out
+of the macro as `<!--slot:name-->` markers (see SLOT) and filled in per
+request with the `fill` filter, which is a plain string replace.
+
+Fragments live in a bounded in-process LRU. An optional shared backend
+(any object with `get(key)` returning a str or None, and `set(key, value)`,
+e.g. a small wrapper around a Redis or memcached client) sits behind it,
+so workers can share what each has rendered.
+
+Configuration (app.config, set from the environment in app.py):
+
+- FRAGMENT_CACHE_SIZE: most fragments kept per process; 0 disables caching.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup, escape
+
+from http_cache import site_version
+
+SLOT = "<!--slot:{}-->"
+
+
+class LRUBackend:
+    """Thread-safe, size-bounded in-process store of fragments."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+
+            if value is not None:
+                self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FragmentCache:
+    """Two-level fragment cache: a local LRU, then an optional shared backend."""
+
+    def __init__(self, app=None, shared=None):
+        self.local = LRUBackend()
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read configuration from `app` and add the template helpers."""
+
+        self.local.max_size = app.config.get('FRAGMENT_CACHE_SIZE',
+                                             self.local.max_size)
+        app.add_template_global(self.render, 'cached_fragment')
+        app.add_template_filter(fill, 'fill')
+
+    def key(self, name, parts):
+        # The site version changes with the templates, so fragments from an
+        # older deploy are never reused from the shared backend.
+        digest = hashlib.md5(repr((site_version(), list(parts))).encode())
+        return f"fragment:{name}:{digest.hexdigest()}"
+
+    def render(self, name, parts, macro, *args):
+        """Cached HTML of `macro(*args)`, keyed by `name` and `parts`."""
+
+        key = self.key(name, parts)
+        html = self.local.get(key)
+
+        if html is None and self.shared is not None:
+            html = self.shared.get(key)
+
+            if html is not None:
+                self.local.set(key, html)
+
+        if html is None:
+            self.misses += 1
+            html = str(macro(*args))
+            self.local.set(key, html)
+
+            if self.shared is not None:
+                self.shared.set(key, html)
+        else:
+            self.hits += 1
+
+        return Markup(html)
+
+    def clear(self):
+        """Empty the local LRU (the shared backend is left alone)."""
+
+        self.local.clear()
+
+
+def fill(html, **slots):
+    """Put each of `slots` into its `<!--slot:name-->` marker in `html`."""
+
+    html = str(html)
+
+    for name, value in slots.items():
+        html = html.replace(SLOT.format(name), str(escape(value)))
+
+    return Markup(html)
+
+
+fragment_cache = FragmentCache()
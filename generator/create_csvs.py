@@ -3,26 +3,55 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+It also produces production-sized datasets for load testing, e.g.:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 200000000 --likes 50000000 --blocks 1000000 \\
+        --shards 64 --workers 8 --out /data/warbler-big
+
+Rows are written as they are generated, so memory stays flat. Followers,
+message authors and liked messages follow a power law: a few users and
+messages get most of the attention, like on a real site. Output is
+deterministic for a given --seed, however many --workers are used.
+Nothing is fetched from the network.
+
+With --shards N each table is split by id range into N files
+(users-00000.csv, ...) that can be generated and loaded in parallel;
+seed.py loads either layout.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+from helpers import get_random_datetime, power_law_choice, scatter
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+BLOCKS_CSV_HEADERS = ['user_being_blocked_id', 'user_blocking_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Every generated user has this password: "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Fixed "now" so timestamps don't depend on when the generator is run.
+GENERATED_AT = datetime(2020, 1, 1)
+
+WORDS = LoremProvider.word_list
+PLACE_SUFFIXES = ['ville', 'burgh', 'ton', 'port', 'field', 'mouth', ' City']
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +61,190 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+    "/static/images/nav-bg.png",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def sentence(rng, min_words, max_words):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def shard_range(total, shards, shard):
+    """Ids (1-based, inclusive start, exclusive end) covered by `shard`."""
+
+    size = -(-total // shards)
+    return 1 + shard * size, 1 + min(total, (shard + 1) * size)
+
+
+def per_owner_count(rng, mean, limit):
+    """How many follows/likes/blocks one user makes: exponential around `mean`."""
+
+    if mean <= 0:
+        return 0
+
+    return min(round(rng.expovariate(1 / mean)), limit)
+
+
+def popular_ids(rng, k, n, exclude=None):
+    """Up to `k` distinct ids in 1..n, power-law distributed, without `exclude`.
+
+    Popular ids repeat often, so keep drawing (within reason) until there
+    are `k` of them.
+    """
+
+    ids = set()
+
+    for _ in range(4 * k):
+        if len(ids) == k:
+            break
+
+        chosen = scatter(power_law_choice(rng, n), n)
+
+        if chosen != exclude:
+            ids.add(chosen)
+
+    return ids
+
+
+def write_users(writer, rng, start, end, opts):
+    for i in range(start, end):
+        first, second = rng.choice(WORDS), rng.choice(WORDS)
+        writer.writerow([
+            i,
+            f"{first}.{second}{i}@example.com",
+            f"{first}{second}{i}",
+            rng.choice(image_urls),
+            PASSWORD,
+            sentence(rng, 4, 10),
+            rng.choice(header_image_urls),
+            rng.choice(WORDS).title() + rng.choice(PLACE_SUFFIXES),
+        ])
+
+
+def write_messages(writer, rng, start, end, opts):
+    for i in range(start, end):
+        writer.writerow([
+            i,
+            sentence(rng, 5, 25)[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng=rng, now=GENERATED_AT),
+            scatter(power_law_choice(rng, opts.users), opts.users),
+        ])
+
+
+def write_follows(writer, rng, start, end, opts):
+    # Each follower picks a set of distinct users to follow, so (followed,
+    # follower) pairs never repeat without a global dedupe.
+    mean = opts.follows / opts.users
+
+    for follower in range(start, end):
+        count = per_owner_count(rng, mean, opts.users - 1)
+        followed = popular_ids(rng, count, opts.users, exclude=follower)
+
+        for followed_id in sorted(followed):
+            writer.writerow([followed_id, follower])
+
+
+def write_likes(writer, rng, start, end, opts):
+    mean = opts.likes / opts.users
+
+    for user_id in range(start, end):
+        count = per_owner_count(rng, mean, opts.messages)
+        liked = popular_ids(rng, count, opts.messages)
+
+        for message_id in sorted(liked):
+            writer.writerow([user_id, message_id])
+
+
+def write_blocks(writer, rng, start, end, opts):
+    mean = opts.blocks / opts.users
+
+    for blocker in range(start, end):
+        blocked = {rng.randint(1, opts.users)
+                   for _ in range(per_owner_count(rng, mean, opts.users - 1))}
+        blocked.discard(blocker)
+
+        for blocked_id in sorted(blocked):
+            writer.writerow([blocked_id, blocker])
+
+
+# table name -> (headers, row writer, option giving the id range to shard)
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users, 'users'),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages, 'messages'),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, 'users'),
+    'likes': (LIKES_CSV_HEADERS, write_likes, 'users'),
+    'blocks': (BLOCKS_CSV_HEADERS, write_blocks, 'users'),
+}
+
+
+def csv_path(opts, table, shard):
+    if opts.shards == 1:
+        return os.path.join(opts.out, f"{table}.csv")
+
+    return os.path.join(opts.out, f"{table}-{shard:05d}.csv")
+
+
+def generate_shard(job):
+    """Write one shard of one table. Runs in a worker process."""
+
+    table, shard, opts = job
+    headers, write_rows, range_option = TABLES[table]
+    start, end = shard_range(getattr(opts, range_option), opts.shards, shard)
+
+    # Seeded per table and shard, so output doesn't depend on scheduling.
+    rng = Random(f"{opts.seed}-{table}-{shard}")
+
+    with open(csv_path(opts, table, shard), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+        write_rows(writer, rng, start, end, opts)
+
+    return table, shard
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="approximate total number of follows")
+    parser.add_argument('--likes', type=int, default=0,
+                        help="approximate total number of likes")
+    parser.add_argument('--blocks', type=int, default=0,
+                        help="approximate total number of blocks")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--out', default='generator')
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    os.makedirs(opts.out, exist_ok=True)
+
+    tables = ['users', 'messages', 'follows']
+    tables += [table for table in ['likes', 'blocks'] if getattr(opts, table)]
+
+    jobs = [(table, shard, opts)
+            for table in tables
+            for shard in range(opts.shards)]
+
+    if opts.workers > 1:
+        with Pool(opts.workers) as pool:
+            for table, shard in pool.imap_unordered(generate_shard, jobs):
+                print(f"wrote {csv_path(opts, table, shard)}")
+    else:
+        for job in jobs:
+            table, shard = generate_shard(job)
+            print(f"wrote {csv_path(opts, table, shard)}")
+
+
+if __name__ == '__main__':
+    main()
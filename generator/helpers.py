@@ -1,14 +1,44 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime (naive, UTC) within the last few years.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    Pass a seeded `rng` and a fixed `now` (naive UTC) for reproducible
+    output; the local time zone never comes into it.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    now = now or datetime.utcnow()
+    then = now - timedelta(days=365 * year_gap)
+    offset = rng.uniform(0, (now - then).total_seconds())
+
+    return then + timedelta(seconds=offset)
+
+
+def power_law_choice(rng, n):
+    """Pick an id in 1..n where id k is chosen with probability ~ 1/k.
+
+    A few low ids are very popular and most ids are rarely picked, which
+    mimics follower counts and message activity on real social sites.
+    """
+
+    return min(int(n ** rng.random()), n)
+
+
+def scatter(k, n):
+    """Map 1..n onto itself in a scrambled but fixed order.
+
+    Used so the most popular ids chosen by power_law_choice aren't simply
+    the oldest users.
+    """
+
+    multiplier = 2654435761
+
+    while gcd(multiplier, n) != 1:
+        multiplier += 2
+
+    return (k * multiplier) % n + 1
@@ -0,0 +1,59 @@
+"""gunicorn settings for Warbler (read by `gunicorn app:app`).
+
+Workers are threaded (gthread): while a request waits on PostgreSQL or on
+the password hashing pool, the worker's other threads keep serving, so a
+few processes handle many concurrent requests in far less memory than
+one sync process per request. Each thread holds at most one database
+connection, so the pool is sized to the thread count.
+
+Settings come from the environment, with defaults for a small dyno:
+
+- WEB_CONCURRENCY: worker processes (default: one per CPU).
+- WEB_THREADS: threads per worker.
+- WEB_WORKER_CLASS: gthread, or sync to go back to one request per process.
+- WEB_TIMEOUT: seconds a request may run before its worker is restarted.
+
+The app is loaded once in the master (preload_app) and the workers fork
+from it, sharing its memory; the hooks below keep database connections
+from leaking across the fork (see db_pool.py).
+"""
+
+import multiprocessing
+import os
+
+import db_pool
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+# gunicorn turns sync workers into gthread ones if threads > 1.
+threads = int(os.environ.get('WEB_THREADS', 8 if worker_class == 'gthread' else 1))
+
+# Connections are re-used across requests from the same browser or load
+# balancer; an idle keep-alive connection doesn't tie up a gthread thread.
+keepalive = 5
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = 30
+
+# Recycle workers now and then so slow leaks can't build up; the jitter
+# keeps them from all restarting at once.
+max_requests = 2000
+max_requests_jitter = 200
+
+preload_app = True
+
+# Heartbeat files on a RAM disk: a slow /tmp can stall workers into timeouts.
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# One connection per thread, so requests never queue for the pool.
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+
+def pre_fork(server, worker):
+    # Workers must not inherit open database connections (see db_pool.py).
+    db_pool.pools.dispose_all()
+
+
+def post_fork(server, worker):
+    db_pool.pools.reset_after_fork()
@@ -0,0 +1,147 @@
+"""HTTP caching for Warbler: versioned static URLs and conditional GETs.
+
+Static files are linked as /static/<file>?v=<content hash> (see
+static_url(), available in templates). A request carrying the file's
+current hash can be cached by browsers for a year, since any change to the
+file changes its URL; anything else under /static must revalidate.
+
+Pages call not_modified() with an ETag built by etag_for() from everything
+they render (the rows' versions, the viewer's state) *before* doing the
+expensive work, and return its 304 response if the browser's copy is still
+good; otherwise they render and pass the response through
+add_validators().
+
+    etag = etag_for(g.user.id, user.updated_at, ...)
+    cached = not_modified(etag, user.updated_at)
+    if cached:
+        return cached
+    ...
+    return add_validators(make_response(render_template(...)), etag,
+                          user.updated_at)
+"""
+
+import hashlib
+import os
+import threading
+
+from flask import current_app, request, session, Response
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+_site_version = None
+
+
+def file_hash(path):
+    """Short hash of the file at `path`, cached until its mtime changes."""
+
+    mtime = os.stat(path).st_mtime
+
+    with _hashes_lock:
+        cached = _hashes.get(path)
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as static_file:
+        digest = hashlib.md5(static_file.read()).hexdigest()[:12]
+
+    with _hashes_lock:
+        _hashes[path] = (mtime, digest)
+
+    return digest
+
+
+def static_url(filename):
+    """URL for a static file that changes whenever the file does."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    return f"{current_app.static_url_path}/{filename}?v={file_hash(path)}"
+
+
+def site_version():
+    """Hash of the templates and static files, computed once per process.
+
+    Part of every ETag, so a deploy that changes how pages look doesn't
+    leave browsers holding on to old pages.
+    """
+
+    global _site_version
+
+    if _site_version is None:
+        digest = hashlib.md5()
+
+        for folder in (current_app.template_folder, current_app.static_folder):
+            folder = os.path.join(current_app.root_path, folder)
+
+            for root, _, files in sorted(os.walk(folder)):
+                for name in sorted(files):
+                    digest.update(file_hash(os.path.join(root, name)).encode())
+
+        _site_version = digest.hexdigest()[:12]
+
+    return _site_version
+
+
+def etag_for(*parts):
+    """ETag for a page rendered from `parts` (any values with a stable repr)."""
+
+    return hashlib.md5(repr((site_version(),) + parts).encode()).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """A 304 response if the browser's copy matches, else None.
+
+    Only If-None-Match is checked. Every page depends on who is viewing it
+    (the navbar, follow and block buttons), which the ETag covers and a
+    date can't, so If-Modified-Since alone never gets a 304;
+    `last_modified` is only sent back as a header.
+
+    Pages with flashed messages waiting are always rendered, so the
+    messages get shown.
+    """
+
+    if request.method != 'GET' or '_flashes' in session:
+        return None
+
+    if not request.if_none_match or not request.if_none_match.contains(etag):
+        return None
+
+    return add_validators(Response(status=304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified=None):
+    """Mark `response` revalidatable with `etag` and `last_modified`."""
+
+    response.set_etag(etag)
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    # Pages are per viewer: shared caches mustn't store them, and browsers
+    # must check back (cheaply, via the ETag) before reusing them.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cache_headers(response):
+    """after_request hook setting Cache-Control on every response."""
+
+    if request.endpoint == 'static':
+        filename = request.view_args.get('filename', '')
+        path = os.path.join(current_app.static_folder, filename)
+        version = request.args.get('v')
+
+        if version and os.path.isfile(path) and version == file_hash(path):
+            response.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+
+        response.headers.pop('Expires', None)
+
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
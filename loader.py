@@ -0,0 +1,176 @@
+"""Stream CSV files into Warbler tables.
+
+On PostgreSQL each file is fed to `COPY ... FROM STDIN` in chunks of
+CHUNK_ROWS rows, so memory use stays flat however big the file is. Other
+databases (SQLite in development) fall back to chunked executemany
+INSERTs.
+
+For big loads on PostgreSQL, wrap the loads in `deferred_constraints()`:
+secondary indexes and foreign keys are dropped first and rebuilt once the
+data is in, which is much faster than maintaining them row by row.
+
+    with deferred_constraints():
+        load_csv('users', 'generator/users.csv')
+        load_csv('messages', 'generator/messages.csv')
+    resync_sequences()
+"""
+
+import csv
+import io
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from models import db
+
+CHUNK_ROWS = 50000
+
+
+def _is_postgres():
+    return db.engine.dialect.name == "postgresql"
+
+
+def _chunks(rows, size):
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _report(table, rows, start, out):
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"{table}: {rows:,} rows in {elapsed:.1f}s "
+          f"({rows / elapsed:,.0f} rows/s)", file=out)
+
+
+def load_csv(table_name, path, chunk_rows=CHUNK_ROWS, out=sys.stdout):
+    """Load the CSV at `path` (with a header row) into `table_name`.
+
+    Each chunk is committed as it goes, and progress is printed to `out`
+    after each one. Returns the number of rows loaded.
+    """
+
+    start = time.perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        # Values go to the database as the CSV's strings, untouched by
+        # SQLAlchemy's type conversion, like COPY does.
+        insert = db.text(f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                         f"VALUES ({', '.join(':' + column for column in columns)})")
+
+        for chunk in _chunks(reader, chunk_rows):
+            if _is_postgres():
+                _copy_chunk(table_name, columns, chunk)
+            else:
+                with db.engine.begin() as connection:
+                    connection.execute(insert,
+                                       [dict(zip(columns, row)) for row in chunk])
+
+            loaded += len(chunk)
+            _report(table_name, loaded, start, out)
+
+    return loaded
+
+
+def _copy_chunk(table_name, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    connection = db.engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table_name} ({', '.join(columns)}) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+@contextmanager
+def deferred_constraints(out=sys.stdout):
+    """Drop secondary indexes and foreign keys, and rebuild them on exit.
+
+    Primary keys and unique constraints stay, so bad data still fails
+    fast. Does nothing outside PostgreSQL.
+    """
+
+    if not _is_postgres():
+        yield
+        return
+
+    with db.engine.begin() as connection:
+        foreign_keys = connection.execute(
+            "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+            "FROM pg_constraint "
+            "WHERE contype = 'f' AND connamespace = 'public'::regnamespace"
+        ).fetchall()
+
+        indexes = connection.execute(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname = 'public' AND indexname NOT IN "
+            "(SELECT conname FROM pg_constraint "
+            " WHERE contype IN ('p', 'u', 'x'))"
+        ).fetchall()
+
+        for table_name, name, _ in foreign_keys:
+            connection.execute(f'ALTER TABLE {table_name} DROP CONSTRAINT "{name}"')
+
+        for name, _ in indexes:
+            connection.execute(f'DROP INDEX "{name}"')
+
+    statements = ([definition for _, definition in indexes] +
+                  [f'ALTER TABLE {table_name} ADD CONSTRAINT "{name}" {definition}'
+                   for table_name, name, definition in foreign_keys])
+
+    # Rebuild even if the load fails, so the database isn't left without
+    # its indexes and foreign keys.
+    try:
+        yield
+    finally:
+        start = time.perf_counter()
+
+        try:
+            with db.engine.begin() as connection:
+                for statement in statements:
+                    connection.execute(statement)
+        except Exception:
+            print("could not rebuild indexes and foreign keys; "
+                  "restore them with:", file=out)
+
+            for statement in statements:
+                print(f"{statement};", file=out)
+
+            raise
+
+        print(f"rebuilt {len(indexes)} indexes and {len(foreign_keys)} foreign keys "
+              f"in {time.perf_counter() - start:.1f}s", file=out)
+
+
+def resync_sequences():
+    """Move each serial id sequence past the largest id in its table.
+
+    Needed after loading rows with explicit ids. Does nothing outside
+    PostgreSQL.
+    """
+
+    if not _is_postgres():
+        return
+
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if 'id' not in table.c:
+                continue
+
+            connection.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)")
@@ -0,0 +1,355 @@
+"""Per-request SQL and timing metrics for Warbler.
+
+Cheap enough to leave on in production (unlike the debug toolbar): each
+request just adds up a few perf_counter() readings. For every endpoint
+the Metrics extension tracks
+
+- request count and a latency histogram,
+- SQL statements run and the time spent in them,
+- the slowest statement seen, as a fingerprint with its literals removed,
+- template render time,
+- password hashing time (see passwords.hash_finished), and
+- time spent waiting for a database connection (see
+  db_pool.checkout_finished).
+
+along with the state of each connection pool (see db_pool.py).
+
+They are served in Prometheus text format at /metrics and, if
+SERVER_TIMING is on, summarized per response in a Server-Timing header
+that browser dev tools display.
+
+Configuration (app.config, set from the environment in app.py):
+
+- METRICS_ENABLED: register the hooks and /metrics at all.
+- METRICS_TOKEN: /metrics requires "Authorization: Bearer <token>"; with
+  no token set it answers 404, so metrics are never public.
+- SERVER_TIMING: add Server-Timing headers to responses.
+
+Numbers are per process; with several gunicorn workers, Prometheus sees
+each worker's share on every scrape, so scrape each worker or sum them.
+"""
+
+import hmac
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import (g, request, current_app, has_app_context, abort, Response,
+                   before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from passwords import hash_finished
+from db_pool import checkout_finished
+
+# Upper bounds (seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+MAX_FINGERPRINT_LENGTH = 200
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|(?<!:):\w+|\?")
+_VALUE_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """`statement` with literals and parameters replaced by ?, on one line.
+
+    Statements that differ only in their values (or in the length of an
+    IN list) get the same fingerprint.
+    """
+
+    statement = _LITERALS.sub("?", statement)
+    statement = _VALUE_LISTS.sub("(...)", statement)
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    return statement[:MAX_FINGERPRINT_LENGTH]
+
+
+class RequestTimings:
+    """What one request has spent so far; kept on `g` during the request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.pool_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.template_start = None
+
+    def server_timing(self, total):
+        """Value for the Server-Timing header."""
+
+        return ", ".join([
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_seconds * 1000:.1f}',
+            f'hash;dur={self.hash_seconds * 1000:.1f}',
+            f'pool;dur={self.pool_seconds * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+class EndpointStats:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.pool_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_fingerprint = None
+
+    def add(self, timings, total):
+        self.requests += 1
+        self.seconds += total
+
+        bucket = bisect_left(LATENCY_BUCKETS, total)
+        if bucket < len(self.buckets):
+            self.buckets[bucket] += 1
+
+        self.queries += timings.queries
+        self.db_seconds += timings.db_seconds
+        self.template_seconds += timings.template_seconds
+        self.hash_seconds += timings.hash_seconds
+        self.pool_seconds += timings.pool_seconds
+
+        if timings.slowest_seconds > self.slowest_seconds:
+            self.slowest_seconds = timings.slowest_seconds
+            self.slowest_fingerprint = fingerprint(timings.slowest_statement)
+
+
+def _current_timings():
+    if has_app_context():
+        return g.get('_request_timings')
+
+    return None
+
+
+def _label(value):
+    return (value.replace("\\", "\\\\")
+                 .replace('"', '\\"')
+                 .replace("\n", "\\n"))
+
+
+class Metrics:
+    """Flask extension collecting per-endpoint request metrics."""
+
+    def __init__(self, app=None, passwords=None, pools=None):
+        self.passwords = passwords
+        self.pools = pools
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Hook into `app`'s requests, templates and SQL, and add /metrics."""
+
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+        hash_finished.connect(self._record_hash)
+        checkout_finished.connect(self._record_checkout)
+
+        # Listening on the Engine class covers every engine the app uses.
+        event.listen(Engine, "before_cursor_execute", self._start_query)
+        event.listen(Engine, "after_cursor_execute", self._finish_query)
+        event.listen(Engine, "handle_error", self._abandon_query)
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def _start_request(self):
+        g._request_timings = RequestTimings()
+
+    def _finish_request(self, response):
+        timings = _current_timings()
+
+        if timings is None:
+            return response
+
+        total = time.perf_counter() - timings.start
+        endpoint = request.endpoint or "unmatched"
+
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+
+            stats.add(timings, total)
+
+        if current_app.config.get('SERVER_TIMING', False):
+            response.headers['Server-Timing'] = timings.server_timing(total)
+
+        return response
+
+    def _start_template(self, app, template, context, **extra):
+        timings = _current_timings()
+
+        if timings is not None:
+            timings.template_start = time.perf_counter()
+
+    def _finish_template(self, app, template, context, **extra):
+        timings = _current_timings()
+
+        if timings is not None and timings.template_start is not None:
+            timings.template_seconds += time.perf_counter() - timings.template_start
+            timings.template_start = None
+
+    def _record_hash(self, hasher, seconds):
+        timings = _current_timings()
+
+        if timings is not None:
+            timings.hash_seconds += seconds
+
+    def _record_checkout(self, pool, seconds):
+        timings = _current_timings()
+
+        if timings is not None:
+            timings.pool_seconds += seconds
+
+    def _start_query(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def _finish_query(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        timings = _current_timings()
+
+        if timings is None:
+            return
+
+        timings.queries += 1
+        timings.db_seconds += elapsed
+
+        # Fingerprinting waits for the end of the request, and only the
+        # slowest statement gets it.
+        if elapsed > timings.slowest_seconds:
+            timings.slowest_seconds = elapsed
+            timings.slowest_statement = statement
+
+    def _abandon_query(self, context):
+        # A failed statement never reaches after_cursor_execute; drop its
+        # start time so the next one doesn't pick it up.
+        if context.execution_context is not None:
+            start_times = context.connection.info.get('query_start_time')
+
+            if start_times:
+                start_times.pop()
+
+    def metrics_view(self):
+        """Serve the collected metrics in Prometheus text format."""
+
+        token = current_app.config.get('METRICS_TOKEN')
+
+        if not token:
+            abort(404)
+
+        if not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   f"Bearer {token}"):
+            abort(403)
+
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        """All metrics as Prometheus text exposition format."""
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+
+            lines += ["# HELP warbler_request_duration_seconds Request latency.",
+                      "# TYPE warbler_request_duration_seconds histogram"]
+
+            for endpoint, stats in endpoints:
+                label = f'endpoint="{_label(endpoint)}"'
+                cumulative = 0
+
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'warbler_request_duration_seconds_bucket'
+                                 f'{{{label},le="{bound}"}} {cumulative}')
+
+                lines += [
+                    f'warbler_request_duration_seconds_bucket{{{label},le="+Inf"}} '
+                    f'{stats.requests}',
+                    f'warbler_request_duration_seconds_sum{{{label}}} {stats.seconds}',
+                    f'warbler_request_duration_seconds_count{{{label}}} {stats.requests}',
+                ]
+
+            for name, attr, kind, help_text in [
+                    ('warbler_db_queries_total', 'queries', 'counter',
+                     "SQL statements run."),
+                    ('warbler_db_seconds_total', 'db_seconds', 'counter',
+                     "Time spent running SQL statements."),
+                    ('warbler_template_seconds_total', 'template_seconds', 'counter',
+                     "Time spent rendering templates."),
+                    ('warbler_password_hash_seconds_total', 'hash_seconds', 'counter',
+                     "Time spent hashing and checking passwords."),
+                    ('warbler_db_pool_wait_seconds_total', 'pool_seconds', 'counter',
+                     "Time spent waiting for a database connection."),
+                    ('warbler_slowest_query_seconds', 'slowest_seconds', 'gauge',
+                     "Slowest SQL statement seen."),
+            ]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+                for endpoint, stats in endpoints:
+                    label = f'endpoint="{_label(endpoint)}"'
+
+                    if attr == 'slowest_seconds':
+                        if stats.slowest_fingerprint is None:
+                            continue
+                        label += f',statement="{_label(stats.slowest_fingerprint)}"'
+
+                    lines.append(f"{name}{{{label}}} {getattr(stats, attr)}")
+
+        if self.passwords is not None:
+            pool = self.passwords.stats()
+            lines += [
+                "# HELP warbler_password_hash_in_flight Hashes running or queued.",
+                "# TYPE warbler_password_hash_in_flight gauge",
+                f"warbler_password_hash_in_flight {pool['in_flight']}",
+                "# HELP warbler_password_hash_rejected_total Hashes refused as busy.",
+                "# TYPE warbler_password_hash_rejected_total counter",
+                f"warbler_password_hash_rejected_total {pool['rejected']}",
+                "# HELP warbler_password_hash_timeouts_total Hashes that timed out.",
+                "# TYPE warbler_password_hash_timeouts_total counter",
+                f"warbler_password_hash_timeouts_total {pool['timeouts']}",
+            ]
+
+        if self.pools is not None:
+            pools = self.pools.stats()
+
+            for name, field, kind, help_text in [
+                    ('warbler_db_pool_capacity', 'capacity', 'gauge',
+                     "Most connections the pool will open (size + overflow)."),
+                    ('warbler_db_pool_checked_out', 'checked_out', 'gauge',
+                     "Connections in use."),
+                    ('warbler_db_pool_saturation', 'saturation', 'gauge',
+                     "Share of the pool's capacity in use."),
+                    ('warbler_db_pool_checkouts_total', 'checkouts', 'counter',
+                     "Connections checked out."),
+                    ('warbler_db_pool_timeouts_total', 'timeouts', 'counter',
+                     "Checkouts that gave up waiting for a connection."),
+                    ('warbler_db_pool_checkout_wait_seconds_total', 'wait_seconds',
+                     'counter', "Time spent waiting to check connections out."),
+                    ('warbler_db_pool_checkout_wait_max_seconds', 'max_wait_seconds',
+                     'gauge', "Longest wait for a connection."),
+            ]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines += [f'{name}{{pool="{_label(pool["pool"])}"}} {pool[field]}'
+                          for pool in pools]
+
+        return "\n".join(lines) + "\n"
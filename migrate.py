@@ -0,0 +1,335 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration is a script in migrations/ named `<version>_<name>.py`,
+with a docstring saying what it does and an `upgrade(m)` function that
+changes the schema through the Migrator `m` it is given:
+
+    \"\"\"Index likes by message.\"\"\"
+
+    def upgrade(m):
+        m.create_index('ix_likes_message_id', 'likes', 'message_id')
+
+Applied versions are recorded in the schema_migrations table. Run pending
+migrations, in version order, with:
+
+    python migrate.py            # apply everything pending
+    python migrate.py --status   # list applied and pending migrations
+    python migrate.py --stamp    # record everything as applied
+
+seed.py stamps the databases it creates, since db.create_all() already
+builds the current schema.
+
+Migrations run against a live database, so the Migrator's helpers avoid
+long locks: indexes are built with CREATE INDEX CONCURRENTLY, ALTER TABLE
+gives up after LOCK_TIMEOUT rather than queue behind (and block) running
+queries, and backfills update BATCH_SIZE rows per transaction. Every
+helper is safe to repeat, so a migration that fails part way can just be
+run again. The scripts themselves are written for PostgreSQL.
+"""
+
+import argparse
+import glob
+import importlib.util
+import os
+import sys
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from models import db, utcnow
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(HERE, 'migrations')
+
+BATCH_SIZE = 10000
+LOCK_TIMEOUT = '5s'
+LOCK_RETRIES = 5
+
+schema_migrations = db.Table(
+    'schema_migrations', db.MetaData(),
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              server_default=utcnow()),
+)
+
+
+class Migrator:
+    """Online schema changes for migration scripts, on `engine`."""
+
+    def __init__(self, engine, out=sys.stdout):
+        self.engine = engine
+        self.out = out
+
+    @property
+    def is_postgres(self):
+        return self.engine.dialect.name == "postgresql"
+
+    def execute(self, sql, **params):
+        """Run `sql` in a transaction of its own; returns the result."""
+
+        with self.engine.begin() as connection:
+            return connection.execute(text(sql), **params)
+
+    def scalar(self, sql, **params):
+        with self.engine.connect() as connection:
+            return connection.execute(text(sql), **params).scalar()
+
+    def _autocommit(self, sql):
+        # CREATE/DROP INDEX CONCURRENTLY refuse to run in a transaction.
+        with self.engine.connect() as connection:
+            if self.is_postgres:
+                connection = connection.execution_options(
+                    isolation_level='AUTOCOMMIT')
+
+            connection.execute(text(sql))
+
+    def alter(self, sql):
+        """Run a brief DDL statement that takes a strong table lock.
+
+        On PostgreSQL the statement gives up after LOCK_TIMEOUT instead of
+        waiting behind long queries with every later query waiting behind
+        it, and is retried up to LOCK_RETRIES times.
+        """
+
+        for attempt in range(1, LOCK_RETRIES + 1):
+            try:
+                with self.engine.begin() as connection:
+                    if self.is_postgres:
+                        connection.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+
+                    connection.execute(text(sql))
+                return
+            except OperationalError as error:
+                if 'lock timeout' not in str(error) or attempt == LOCK_RETRIES:
+                    raise
+
+                self.log(f"  lock timeout, retrying ({attempt}/{LOCK_RETRIES})")
+                time.sleep(attempt)
+
+    def has_column(self, table, column):
+        return column in {info['name'] for info in
+                          db.inspect(self.engine).get_columns(table)}
+
+    def has_table(self, table):
+        return self.engine.has_table(table)
+
+    def add_column(self, table, column, definition):
+        """ALTER TABLE `table` ADD `column` `definition`, if it's missing.
+
+        With a constant (or now()-like) default this is instant on
+        PostgreSQL 11 and up: existing rows aren't rewritten.
+        """
+
+        if not self.has_column(table, column):
+            self.alter(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def create_table(self, table):
+        """Create `table` (a sqlalchemy Table), with its indexes, if missing."""
+
+        table.create(self.engine, checkfirst=True)
+
+    def create_index(self, name, table, columns, using=None, unique=False):
+        """Build an index without blocking writes to `table`.
+
+        `columns` is the SQL between the parentheses, e.g.
+        "user_id, timestamp DESC". An invalid index left behind by an
+        interrupted concurrent build is dropped and built again.
+        """
+
+        if not self.is_postgres:
+            self._autocommit(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS "
+                f"{name} ON {table} ({columns})")
+            return
+
+        valid = self.scalar(
+            "SELECT indisvalid FROM pg_index "
+            "WHERE indexrelid = to_regclass(:name)", name=name)
+
+        if valid:
+            return
+
+        if valid is not None:
+            self.drop_index(name)
+
+        start = time.perf_counter()
+        self._autocommit(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} "
+            f"ON {table} {f'USING {using} ' if using else ''}({columns})")
+        self.log(f"  built {name} in {time.perf_counter() - start:.1f}s")
+
+    def replace_index(self, name, table, columns, using=None):
+        """Rebuild index `name` with a new definition, online.
+
+        The new index is built alongside the old one, which is dropped
+        once it's ready.
+        """
+
+        if not self.is_postgres:
+            self.drop_index(name)
+            self.create_index(name, table, columns, using)
+            return
+
+        self.create_index(f"{name}_new", table, columns, using)
+        self.drop_index(name)
+        self.alter(f"ALTER INDEX {name}_new RENAME TO {name}")
+
+    def drop_index(self, name):
+        """Drop an index without blocking queries on its table."""
+
+        concurrently = 'CONCURRENTLY ' if self.is_postgres else ''
+        self._autocommit(f"DROP INDEX {concurrently}IF EXISTS {name}")
+
+    def batches(self, table, key='id', batch_size=BATCH_SIZE):
+        """(low, high) ranges covering `table`'s `key` column, `batch_size` wide."""
+
+        with self.engine.connect() as connection:
+            low, high = connection.execute(
+                f"SELECT min({key}), max({key}) FROM {table}").first()
+
+        if low is None:
+            return
+
+        for start in range(low, high + 1, batch_size):
+            yield start, min(start + batch_size - 1, high)
+
+    def backfill(self, table, assignments, where=None, joined=None, key='id',
+                 batch_size=BATCH_SIZE):
+        """UPDATE `table` SET `assignments` [FROM `joined`] [WHERE `where`].
+
+        Runs batch by batch over `key`, each batch its own short
+        transaction, so locks are held briefly and replicas keep up.
+        Returns the rows updated.
+        """
+
+        joined = f" FROM {joined}" if joined else ""
+        condition = f" AND ({where})" if where else ""
+        updated = 0
+        start = time.perf_counter()
+
+        for low, high in self.batches(table, key, batch_size):
+            result = self.execute(
+                f"UPDATE {table} SET {assignments}{joined} "
+                f"WHERE {table}.{key} BETWEEN :low AND :high{condition}",
+                low=low, high=high)
+            updated += result.rowcount
+
+        self.log(f"  backfilled {updated:,} {table} rows "
+                 f"in {time.perf_counter() - start:.1f}s")
+        return updated
+
+    def log(self, line):
+        print(line, file=self.out)
+
+
+def available(directory=MIGRATIONS_DIR):
+    """{version: path} of every migration script in `directory`."""
+
+    scripts = {}
+
+    for path in glob.glob(os.path.join(directory, '[0-9]*_*.py')):
+        version = int(os.path.basename(path).split('_', 1)[0])
+
+        if version in scripts:
+            raise ValueError(f"two migrations numbered {version}: "
+                             f"{scripts[version]} and {path}")
+
+        scripts[version] = path
+
+    return dict(sorted(scripts.items()))
+
+
+def applied(engine):
+    """Versions recorded in schema_migrations."""
+
+    schema_migrations.create(engine, checkfirst=True)
+
+    with engine.connect() as connection:
+        return {row.version for row in
+                connection.execute(schema_migrations.select())}
+
+
+def _record(engine, version, path):
+    name = os.path.basename(path)[:-len('.py')]
+
+    with engine.begin() as connection:
+        connection.execute(schema_migrations.insert(), version=version, name=name)
+
+
+def _load(path):
+    spec = importlib.util.spec_from_file_location(
+        f"migrations.{os.path.basename(path)[:-len('.py')]}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def pending(engine, directory=MIGRATIONS_DIR):
+    done = applied(engine)
+    return {version: path for version, path in available(directory).items()
+            if version not in done}
+
+
+def upgrade(engine, directory=MIGRATIONS_DIR, out=sys.stdout):
+    """Apply every pending migration in version order. Returns their versions."""
+
+    migrator = Migrator(engine, out)
+    versions = []
+
+    for version, path in pending(engine, directory).items():
+        module = _load(path)
+        summary = (module.__doc__ or '').strip().split('\n')[0]
+        print(f"{os.path.basename(path)}: {summary}", file=out)
+
+        start = time.perf_counter()
+        module.upgrade(migrator)
+        _record(engine, version, path)
+        versions.append(version)
+
+        print(f"  done in {time.perf_counter() - start:.1f}s", file=out)
+
+    return versions
+
+
+def stamp(engine, directory=MIGRATIONS_DIR):
+    """Record every migration as applied, without running any."""
+
+    for version, path in pending(engine, directory).items():
+        _record(engine, version, path)
+
+
+def status(engine, directory=MIGRATIONS_DIR, out=sys.stdout):
+    done = applied(engine)
+
+    for version, path in available(directory).items():
+        state = "applied" if version in done else "pending"
+        print(f"{state:8} {os.path.basename(path)}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--status', action='store_true',
+                        help="list applied and pending migrations")
+    action.add_argument('--stamp', action='store_true',
+                        help="record every migration as applied, running none")
+    opts = parser.parse_args()
+
+    from app import app
+
+    # Index builds and backfills may rightly run for a long time.
+    app.config['DB_STATEMENT_TIMEOUT'] = 0
+
+    with app.app_context():
+        if opts.status:
+            status(db.engine)
+        elif opts.stamp:
+            stamp(db.engine)
+        elif not upgrade(db.engine):
+            print("nothing to migrate")
+
+
+if __name__ == '__main__':
+    main()
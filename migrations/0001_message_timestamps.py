@@ -0,0 +1,58 @@
+"""Stamp messages per row in the database, and index them newest first.
+
+messages.timestamp used to default to the time the app was imported, so
+every message a worker process wrote got that worker's start time. This
+moves the default into the database, repairs the stale rows and replaces
+the profile index with newest-first ones.
+
+PostgreSQL only: it relies on CREATE INDEX CONCURRENTLY, UPDATE ... FROM
+and GREATEST, and repairs rows in batches.
+"""
+
+
+def upgrade(m):
+    m.alter("ALTER TABLE messages "
+            "ALTER COLUMN timestamp SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)")
+
+    # Stale rows share a (microsecond) timestamp with the rest of their
+    # worker's messages; there's one such value per worker start.
+    with m.engine.connect() as connection:
+        stale = [row[0] for row in connection.execute(
+            "SELECT timestamp FROM messages GROUP BY timestamp HAVING count(*) > 1")]
+
+    # A stale row's real time is unknown, but it was written after every
+    # message with a lower id, so move it up to the newest of those: a
+    # lower bound on when it was really posted, which puts feeds back in
+    # posting order. `floor` carries the running max across batches.
+    if stale:
+        floor = None
+        fixed = 0
+
+        for low, high in m.batches('messages'):
+            fixed += m.execute(
+                "UPDATE messages SET timestamp = fixed.timestamp "
+                "FROM (SELECT id, GREATEST(max(timestamp) OVER (ORDER BY id), "
+                "                          CAST(:floor AS timestamp)) AS timestamp "
+                "      FROM messages WHERE id BETWEEN :low AND :high) AS fixed "
+                "WHERE messages.id = fixed.id "
+                "  AND messages.timestamp < fixed.timestamp "
+                "  AND messages.timestamp = ANY(:stale)",
+                floor=floor, low=low, high=high, stale=stale).rowcount
+
+            newest = m.scalar("SELECT max(timestamp) FROM messages "
+                              "WHERE id BETWEEN :low AND :high", low=low, high=high)
+            floor = max(filter(None, [floor, newest]), default=None)
+
+        m.log(f"  restamped {fixed:,} messages")
+
+    # Timelines keep a copy of each message's timestamp to sort by.
+    if m.has_table('timelines'):
+        m.backfill('timelines', "timestamp = messages.timestamp",
+                   joined="messages",
+                   where="timelines.message_id = messages.id "
+                         "AND timelines.timestamp <> messages.timestamp",
+                   key='message_id')
+
+    m.replace_index('ix_messages_user_id_timestamp', 'messages',
+                    'user_id, timestamp DESC, id DESC')
+    m.create_index('ix_messages_timestamp', 'messages', 'timestamp DESC, id DESC')
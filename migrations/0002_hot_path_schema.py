@@ -0,0 +1,97 @@
+"""Add the counters, row versions, indexes and timelines the hot paths read.
+
+Brings a database created before them up to date:
+
+- users gets messages_count, following_count, followers_count and
+  likes_count, backfilled from the rows they count, and updated_at;
+- follows and blocks get indexes for lookups by their second column,
+  users and messages the search indexes (see search.py);
+- timelines is created and filled with each user's newest messages.
+
+Writes made by older code between the backfill and the deploy don't touch
+the counters; run User.recount() afterwards to true them up.
+
+PostgreSQL only: it relies on CREATE INDEX CONCURRENTLY, pg_trgm and
+full-text search indexes, and INSERT ... ON CONFLICT, and backfills in
+batches.
+"""
+
+TIMELINE_SIZE = 800
+
+COUNTERS = {
+    'messages_count': "SELECT count(*) FROM messages "
+                      "WHERE messages.user_id = users.id",
+    'following_count': "SELECT count(*) FROM follows "
+                       "WHERE follows.user_following_id = users.id",
+    'followers_count': "SELECT count(*) FROM follows "
+                       "WHERE follows.user_being_followed_id = users.id",
+    'likes_count': "SELECT count(*) FROM likes "
+                   "WHERE likes.user_id = users.id",
+}
+
+CREATE_TIMELINES = """
+CREATE TABLE IF NOT EXISTS timelines (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+)
+"""
+
+# The newest TIMELINE_SIZE messages by, or followed by, users :low to :high.
+FILL_TIMELINES = f"""
+INSERT INTO timelines (user_id, message_id, author_id, timestamp)
+SELECT user_id, message_id, author_id, timestamp
+FROM (SELECT entries.*,
+             row_number() OVER (PARTITION BY user_id
+                                ORDER BY timestamp DESC, message_id DESC) AS position
+      FROM (SELECT follows.user_following_id AS user_id, messages.id AS message_id,
+                   messages.user_id AS author_id, messages.timestamp
+            FROM follows
+            JOIN messages ON messages.user_id = follows.user_being_followed_id
+            WHERE follows.user_following_id BETWEEN :low AND :high
+            UNION ALL
+            SELECT messages.user_id, messages.id, messages.user_id, messages.timestamp
+            FROM messages
+            WHERE messages.user_id BETWEEN :low AND :high) AS entries) AS ranked
+WHERE position <= {TIMELINE_SIZE}
+ON CONFLICT DO NOTHING
+"""
+
+
+def upgrade(m):
+    for column in COUNTERS:
+        m.add_column('users', column, "INTEGER NOT NULL DEFAULT 0")
+
+    m.add_column('users', 'updated_at',
+                 "TIMESTAMP WITHOUT TIME ZONE NOT NULL "
+                 "DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)")
+
+    m.backfill('users', ", ".join(f"{column} = ({count})"
+                                  for column, count in COUNTERS.items()),
+               batch_size=1000)
+
+    m.create_index('ix_follows_user_following_id', 'follows',
+                   'user_following_id, user_being_followed_id')
+    m.replace_index('ix_blocks_user_blocking_id', 'blocks',
+                    'user_blocking_id, user_being_blocked_id')
+
+    m.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    m.create_index('ix_users_username_trgm', 'users', 'username gin_trgm_ops',
+                   using='gin')
+    m.create_index('ix_messages_text_fts', 'messages',
+                   "to_tsvector('english', text)", using='gin')
+
+    # A new table isn't read by anything yet, so it can be filled before
+    # its indexes are built, which is quicker.
+    m.execute(CREATE_TIMELINES)
+
+    if m.scalar("SELECT count(*) FROM (SELECT 1 FROM timelines LIMIT 1) AS any_row") == 0:
+        for low, high in m.batches('users', batch_size=1000):
+            m.execute(FILL_TIMELINES, low=low, high=high)
+
+    m.create_index('ix_timelines_user_id_timestamp', 'timelines',
+                   'user_id, timestamp, message_id')
+    m.create_index('ix_timelines_user_id_author_id', 'timelines',
+                   'user_id, author_id')
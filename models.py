@@ -1,14 +1,37 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from sqlalchemy import event, DDL
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from passwords import PasswordHasher
+from replicas import SQLAlchemy
 
-bcrypt = Bcrypt()
+passwords = PasswordHasher()
 db = SQLAlchemy()
 
 
+class utcnow(FunctionElement):
+    """The current UTC time, evaluated by the database for each row.
+
+    Timestamps are stored without a time zone, in UTC; PostgreSQL's now()
+    would give the server's local time instead.
+    """
+
+    type = db.DateTime()
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -26,6 +49,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers lookups by user_being_followed_id; this covers
+    # "who does this user follow?"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """ Connection of likes messages between users and messages """
@@ -44,6 +74,43 @@ class Likes(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def liked_messages(cls, user_id, hidden_author_ids=()):
+        """Query for the messages `user_id` likes, authors joined in.
+
+        Messages by `hidden_author_ids` (e.g. users blocking the viewer)
+        are left out. Walks the likes primary key for `user_id`, so
+        ordering by Likes.message_id needs no sort.
+        """
+
+        query = (Message.query
+                 .join(cls, cls.message_id == Message.id)
+                 .filter(cls.user_id == user_id)
+                 .options(db.joinedload(Message.user)))
+
+        if hidden_author_ids:
+            query = query.filter(Message.user_id.notin_(hidden_author_ids))
+
+        return query
+
+    @classmethod
+    def visible_count(cls, user, hidden_author_ids=()):
+        """How many of `user`'s likes are of messages not by `hidden_author_ids`.
+
+        With nothing hidden that's just the user's likes_count counter.
+        """
+
+        if not hidden_author_ids:
+            return user.likes_count
+
+        return (db.session
+                .query(db.func.count())
+                .select_from(cls)
+                .join(Message, cls.message_id == Message.id)
+                .filter(cls.user_id == user.id,
+                        Message.user_id.notin_(hidden_author_ids))
+                .scalar())
+
 
 class Blocks(db.Model):
     """ Connection of users who have blocked each other and have been blocked """
@@ -62,6 +129,27 @@ class Blocks(db.Model):
         primary_key=True,
     )
 
+    # The second column lets "who does this user block?" be paged in order
+    # straight off the index.
+    __table_args__ = (
+        db.Index('ix_blocks_user_blocking_id',
+                 'user_blocking_id', 'user_being_blocked_id'),
+    )
+
+    @classmethod
+    def blocker_ids(cls, user_id):
+        """Return the set of ids of users who are blocking `user_id`.
+
+        Only the rows for `user_id` are read, using the primary key (which
+        leads with user_being_blocked_id), so the cost depends on how many users block
+        `user_id` rather than on the size of the blocks table.
+        """
+
+        rows = (db.session
+                .query(cls.user_blocking_id)
+                .filter(cls.user_being_blocked_id == user_id))
+
+        return {row.user_blocking_id for row in rows}
 
 
 class User(db.Model):
@@ -109,6 +197,47 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counters so profile headers don't load whole collections.
+    # Kept up to date by the views that change them (see adjust_counts);
+    # `flask recount-stats` recomputes them from scratch.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Row version for HTTP caching (Last-Modified). Bumped by every UPDATE
+    # through the ORM or Query.update(), counter adjustments included.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=utcnow(),
+        onupdate=utcnow(),
+    )
+
     messages = db.relationship('Message', cascade="all, delete")
 
     followers = db.relationship(
@@ -141,22 +270,243 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def serialize(self):
+        """Serialize the public parts of a user to a dict for JSON responses."""
+
+        return {
+            "id": self.id,
+            "username": self.username,
+            "image_url": self.image_url,
+            "header_image_url": self.header_image_url,
+            "bio": self.bio,
+            "location": self.location,
+        }
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if other_user is None:
+            return False
+
+        return _exists(Follows.query.filter(
+            Follows.user_being_followed_id == self.id,
+            Follows.user_following_id == other_user.id))
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if other_user is None:
+            return False
+
+        return _exists(Follows.query.filter(
+            Follows.user_following_id == self.id,
+            Follows.user_being_followed_id == other_user.id))
     
     def is_blocking(self, other_user):
         """ Is this user blocking other_user? """
-        found_user_list = [user for user in self.blocked_users if user == other_user]
-        return len(found_user_list) == 1
+
+        if other_user is None:
+            return False
+
+        return _exists(Blocks.query.filter(
+            Blocks.user_blocking_id == self.id,
+            Blocks.user_being_blocked_id == other_user.id))
+
+    def followed_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set of ids.
+
+        One query for a whole page of users, so list pages don't need a
+        follow check per row.
+        """
+
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+
+        return {row.user_being_followed_id for row in rows}
+
+    def liked_among(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set of ids.
+
+        One lookup on the likes primary key for a page of messages, rather
+        than loading every message the user has ever liked.
+        """
+
+        message_ids = list(message_ids)
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+
+        return {row.message_id for row in rows}
+
+    def blocked_among(self, user_ids):
+        """Which of `user_ids` is this user blocking? Returns a set of ids."""
+
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Blocks.user_being_blocked_id)
+                .filter(Blocks.user_blocking_id == self.id,
+                        Blocks.user_being_blocked_id.in_(user_ids)))
+
+        return {row.user_being_blocked_id for row in rows}
+
+    def blocked_count(self):
+        """How many users is this user blocking? (One COUNT, no rows loaded.)"""
+
+        return Blocks.query.filter(Blocks.user_blocking_id == self.id).count()
+
+    # Idempotent follow/like/block changes. Each returns True if it changed
+    # anything, and only then touches counters and timelines, so repeated
+    # or concurrent requests can't double count (or fail on a duplicate
+    # key). Call db.session.commit() afterwards.
+
+    def follow(self, user_id):
+        """Start following `user_id`."""
+
+        if not _insert_ignore(Follows.__table__,
+                              user_being_followed_id=user_id,
+                              user_following_id=self.id):
+            return False
+
+        User.adjust_counts([self.id], following_count=1)
+        User.adjust_counts([user_id], followers_count=1)
+        Timeline.backfill(self.id, user_id)
+        return True
+
+    def unfollow(self, user_id):
+        """Stop following `user_id`."""
+
+        return User._end_follow(self.id, user_id)
+
+    @classmethod
+    def _end_follow(cls, follower_id, followed_id):
+        if not _delete_rows(Follows.query.filter(
+                Follows.user_being_followed_id == followed_id,
+                Follows.user_following_id == follower_id)):
+            return False
+
+        cls.adjust_counts([follower_id], following_count=-1)
+        cls.adjust_counts([followed_id], followers_count=-1)
+        Timeline.purge(follower_id, followed_id)
+        return True
+
+    def like(self, message_id):
+        """Like the message `message_id`."""
+
+        if not _insert_ignore(Likes.__table__,
+                              user_id=self.id,
+                              message_id=message_id):
+            return False
+
+        User.adjust_counts([self.id], likes_count=1)
+        return True
+
+    def unlike(self, message_id):
+        """Take back a like of the message `message_id`."""
+
+        if not _delete_rows(Likes.query.filter(Likes.user_id == self.id,
+                                               Likes.message_id == message_id)):
+            return False
+
+        User.adjust_counts([self.id], likes_count=-1)
+        return True
+
+    def block(self, user_id):
+        """Block `user_id`, ending any follows between the two users."""
+
+        if not _insert_ignore(Blocks.__table__,
+                              user_being_blocked_id=user_id,
+                              user_blocking_id=self.id):
+            return False
+
+        User._end_follow(self.id, user_id)
+        User._end_follow(user_id, self.id)
+        # The blocker's profile shows how many users they block.
+        User.adjust_counts([self.id])
+        return True
+
+    def unblock(self, user_id):
+        """Stop blocking `user_id`."""
+
+        if not _delete_rows(Blocks.query.filter(
+                Blocks.user_being_blocked_id == user_id,
+                Blocks.user_blocking_id == self.id)):
+            return False
+
+        User.adjust_counts([self.id])
+        return True
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of `user_ids` in a single UPDATE.
+
+        Example: User.adjust_counts([user.id], messages_count=1)
+
+        The increment happens in SQL, so concurrent requests don't lose
+        updates. Call it in the same transaction as the change it counts.
+
+        updated_at is bumped as well, so with no deltas this just marks the
+        users' pages changed (e.g. their Blocked count, which isn't a
+        counter column).
+        """
+
+        if not user_ids:
+            return
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        values[cls.updated_at] = utcnow()
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute the counters of `user_ids` (default: every user).
+
+        Used to repair drift and after bulk loads that bypass the views.
+        """
+
+        counts = {
+            cls.messages_count: (db.select([db.func.count(Message.id)])
+                                 .where(Message.user_id == cls.id)
+                                 .as_scalar()),
+            cls.following_count: (db.select([db.func.count()])
+                                  .select_from(Follows)
+                                  .where(Follows.user_following_id == cls.id)
+                                  .as_scalar()),
+            cls.followers_count: (db.select([db.func.count()])
+                                  .select_from(Follows)
+                                  .where(Follows.user_being_followed_id == cls.id)
+                                  .as_scalar()),
+            cls.likes_count: (db.select([db.func.count()])
+                              .select_from(Likes)
+                              .where(Likes.user_id == cls.id)
+                              .as_scalar()),
+        }
+
+        query = cls.query
+
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        query.update(counts, synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -165,8 +515,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('utf8')
-        # hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -187,18 +536,36 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with an outdated cost factor, it is
+        replaced with a fresh one; the caller commits the change.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password_hash(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.generate_password_hash(password)
                 return user
 
         return False
 
 
+# Trigram index for username search (see search.py). PostgreSQL only; other
+# databases fall back to unindexed LIKE.
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'))
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL("CREATE INDEX ix_users_username_trgm "
+        "ON users USING gin (username gin_trgm_ops)").execute_if(dialect='postgresql'))
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -217,7 +584,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -228,6 +595,287 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # Read the database's timestamp back with the insert (RETURNING on
+    # PostgreSQL): fan-out copies it straight into the timelines.
+    __mapper_args__ = {'eager_defaults': True}
+
+    def serialize(self):
+        """Serialize message to a dict for JSON responses."""
+
+        return {
+            "id": self.id,
+            "text": self.text,
+            "timestamp": self.timestamp.isoformat(),
+            "user_id": self.user_id,
+        }
+
+
+# Newest-first indexes for profile pages and for feeds across all users,
+# matching their ORDER BY timestamp DESC, id DESC.
+db.Index('ix_messages_user_id_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+db.Index('ix_messages_timestamp', Message.timestamp.desc(), Message.id.desc())
+
+# Full-text index for message search (see search.py). PostgreSQL keeps it
+# current on every insert; other databases fall back to LIKE.
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE INDEX ix_messages_text_fts "
+        "ON messages USING gin (to_tsvector('english', text))"
+        ).execute_if(dialect='postgresql'))
+
+
+class Timeline(db.Model):
+    """Precomputed home timeline entry: `message_id` shows up for `user_id`.
+
+    Entries are written when a message is posted (fan-out on write) and
+    each user's timeline is trimmed back to the newest TIMELINE_SIZE
+    entries now and then (see fan_out), so the homepage reads one
+    already-sorted slice instead of searching every followed user's
+    messages.
+    """
+
+    __tablename__ = 'timelines'
+
+    TIMELINE_SIZE = 800
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'),
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to the timelines of its author and their followers."""
+
+        follower_ids = (db.session
+                        .query(Follows.user_following_id)
+                        .filter(Follows.user_being_followed_id == message.user_id))
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           author_id=message.user_id,
+                           timestamp=message.timestamp))
+
+        entries = (db.session
+                   .query(Follows.user_following_id,
+                          db.literal(message.id),
+                          db.literal(message.user_id),
+                          db.literal(message.timestamp))
+                   .filter(Follows.user_being_followed_id == message.user_id))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            entries.statement))
+        db.session.flush()
+
+        # Trimming on every post would cost a pass over each reader's
+        # timeline, undoing what fan-out saves. Instead one post in
+        # TIMELINE_SIZE trims its readers' timelines in one statement, and
+        # in between timelines may run a little past TIMELINE_SIZE.
+        if message.id % cls.TIMELINE_SIZE == 0:
+            cls.trim(follower_ids.union(
+                db.session.query(db.literal(message.user_id))))
+
+    @classmethod
+    def backfill(cls, user_id, author_id):
+        """Copy the newest messages of `author_id` into `user_id`'s timeline.
+
+        Used when `user_id` starts following `author_id`.
+        """
+
+        newest = (db.session
+                  .query(db.literal(user_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(Message.user_id == author_id,
+                          ~Message.id.in_(db.session
+                                          .query(cls.message_id)
+                                          .filter(cls.user_id == user_id,
+                                                  cls.author_id == author_id)))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(cls.TIMELINE_SIZE))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            newest.statement))
+
+        cls.trim([user_id])
+
+    @classmethod
+    def purge(cls, user_id, author_id):
+        """Remove every message by `author_id` from `user_id`'s timeline.
+
+        Used on unfollow and block.
+        """
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.author_id == author_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def trim(cls, user_ids):
+        """Drop all but the newest TIMELINE_SIZE entries for `user_ids`.
+
+        `user_ids` may be a list or a query returning user ids. Runs as a
+        single DELETE however many timelines it covers.
+        """
+
+        # Number each timeline's entries once, newest first, rather than
+        # re-running a per-row "newest N" subquery for every entry.
+        positions = (db.session
+                     .query(cls.user_id,
+                            cls.message_id,
+                            db.func.row_number().over(
+                                partition_by=cls.user_id,
+                                order_by=(cls.timestamp.desc(),
+                                          cls.message_id.desc()),
+                            ).label('position'))
+                     .filter(cls.user_id.in_(user_ids))
+                     .subquery())
+
+        overflow = (db.session
+                    .query(positions.c.user_id, positions.c.message_id)
+                    .filter(positions.c.position > cls.TIMELINE_SIZE))
+
+        (cls.query
+         .filter(db.tuple_(cls.user_id, cls.message_id).in_(overflow))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """Recompute `user_id`'s timeline from scratch.
+
+        Useful after bulk loads (see seed.py) that bypass fan-out.
+        """
+
+        cls.query.filter(cls.user_id == user_id).delete()
+
+        followed_ids = (db.session
+                        .query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == user_id))
+
+        newest = (db.session
+                  .query(db.literal(user_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(db.or_(Message.user_id == user_id,
+                                 Message.user_id.in_(followed_ids)))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(cls.TIMELINE_SIZE))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            newest.statement))
+
+    @classmethod
+    def rebuild_all(cls):
+        """Recompute every user's timeline in one set-based statement.
+
+        For bulk loads, where calling rebuild() per user is too slow.
+        """
+
+        cls.query.delete()
+
+        followed = (db.session
+                    .query(Follows.user_following_id.label('user_id'),
+                           Message.id.label('message_id'),
+                           Message.user_id.label('author_id'),
+                           Message.timestamp.label('timestamp'))
+                    .join(Message,
+                          Message.user_id == Follows.user_being_followed_id))
+        own = db.session.query(Message.user_id.label('user_id'),
+                               Message.id.label('message_id'),
+                               Message.user_id.label('author_id'),
+                               Message.timestamp.label('timestamp'))
+        entries = followed.union_all(own).subquery()
+
+        ranked = db.session.query(
+            entries,
+            db.func.row_number().over(
+                partition_by=entries.c.user_id,
+                order_by=(entries.c.timestamp.desc(),
+                          entries.c.message_id.desc())).label('position')
+        ).subquery()
+
+        newest = (db.session
+                  .query(ranked.c.user_id,
+                         ranked.c.message_id,
+                         ranked.c.author_id,
+                         ranked.c.timestamp)
+                  .filter(ranked.c.position <= cls.TIMELINE_SIZE))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            newest.statement))
+
+    @classmethod
+    def feed_query(cls, user_id):
+        """Query for the messages on `user_id`'s timeline.
+
+        Callers order it by (Timeline.timestamp, Timeline.message_id), which
+        the ix_timelines_user_id_timestamp index serves directly. Authors
+        are joined in, since every rendered message shows its user.
+        """
+
+        return (Message
+                .query
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id)
+                .options(db.joinedload(Message.user)))
+
+
+def _exists(query):
+    """Run `SELECT EXISTS (query)`; True if it matches any row."""
+
+    return db.session.query(query.exists()).scalar()
+
+
+def _insert_ignore(table, **values):
+    """INSERT a row into `table`, unless its key is taken. True if inserted."""
+
+    insert = table.insert().values(**values)
+
+    if db.engine.dialect.name == "postgresql":
+        insert = postgresql.insert(table).values(**values).on_conflict_do_nothing()
+    else:
+        insert = insert.prefix_with("OR IGNORE", dialect="sqlite")
+
+    return db.session.execute(insert).rowcount == 1
+
+
+def _delete_rows(query):
+    """DELETE what `query` matches; True if it matched anything."""
+
+    return query.delete(synchronize_session=False) > 0
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,82 @@
+"""Keyset (cursor) pagination helpers for Warbler.
+
+Pages are selected with `WHERE (col1, col2) < (cursor)` plus
+`ORDER BY col1 DESC, col2 DESC LIMIT n`. Backed by a matching index, that
+costs the same for page 50 as for page 1, unlike OFFSET.
+
+Cursors are plain strings so they can ride along in a `before=` query
+param: `<iso timestamp>_<id>` for messages, and `<id>` for users and for
+pages keyed by id alone (like a user's likes).
+"""
+
+from datetime import datetime
+
+from models import db
+
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 100
+
+
+def keyset_page(query, columns, before, per_page, key=None):
+    """Return (rows, next_before) for one page of `query`.
+
+    `columns` are the sort key, newest first; `before` is a tuple of values
+    for those columns (or None for the first page). `next_before` is the
+    key tuple of the last row shown, or None if there are no more rows.
+
+    `key` maps a row to its key tuple; by default the column names are
+    read off the row.
+    """
+
+    if before is not None:
+        query = query.filter(db.tuple_(*columns) < before)
+
+    rows = (query
+            .order_by(*[column.desc() for column in columns])
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    last = rows[per_page - 1]
+
+    if key is None:
+        next_before = tuple(getattr(last, column.key) for column in columns)
+    else:
+        next_before = key(last)
+
+    return rows[:per_page], next_before
+
+
+def encode_cursor(key):
+    """Turn a key tuple from `keyset_page` into a `before=` string."""
+
+    if key is None:
+        return None
+
+    return "_".join(value.isoformat() if isinstance(value, datetime)
+                    else str(value)
+                    for value in key)
+
+
+def decode_message_cursor(cursor):
+    """Parse a `<iso timestamp>_<id>` cursor. Returns None if missing/bad."""
+
+    try:
+        timestamp, message_id = cursor.rsplit("_", 1)
+        return (datetime.fromisoformat(timestamp), int(message_id))
+    except (AttributeError, ValueError):
+        return None
+
+
+def decode_id_cursor(cursor):
+    """Parse a `<id>` cursor. Returns None if missing/bad."""
+
+    try:
+        return (int(cursor),)
+    except (TypeError, ValueError):
+        return None
+
+
+decode_user_cursor = decode_id_cursor
@@ -0,0 +1,179 @@
+"""Password hashing service for Warbler.
+
+bcrypt is deliberately slow (hundreds of ms at the default cost), so
+hashing inline ties up a request worker for that long, and a burst of
+logins can starve the rest of the site. PasswordHasher runs bcrypt in a
+small process pool instead, and caps how many hashes may be in flight at
+once: past that cap, callers wait at most PASSWORD_HASH_TIMEOUT for a slot
+and then get PasswordHasherBusy (a 503) rather than piling up.
+
+Configuration (app.config, set from the environment in app.py):
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes. Existing hashes
+  with a different cost are upgraded the next time their user logs in.
+- PASSWORD_HASH_WORKERS: processes in the pool; 0 hashes inline.
+- PASSWORD_HASH_MAX_PENDING: most hashes in flight (running or queued).
+- PASSWORD_HASH_TIMEOUT: seconds to wait for a free slot or a result.
+
+Each finished hash or check sends the `hash_finished` signal with the
+seconds it took (queueing included), for request metrics.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+from blinker import Namespace
+
+_signals = Namespace()
+
+hash_finished = _signals.signal('password-hash-finished')
+
+
+class PasswordHasherBusy(Exception):
+    """Too many hashes in flight; the caller should ask the user to retry."""
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf8'),
+                         bcrypt.gensalt(rounds)).decode('utf8')
+
+
+def _check_password(hashed, password):
+    return bcrypt.checkpw(password.encode('utf8'), hashed.encode('utf8'))
+
+
+class PasswordHasher:
+    """Hash and check passwords in a bounded process pool."""
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = 2
+        self.max_pending = 16
+        self.timeout = 10
+
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read configuration from `app`."""
+
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING',
+                                          self.max_pending)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def generate_password_hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash_password, password, self.rounds)
+
+    def check_password_hash(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(_check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        """Snapshot of pool counters, for metrics."""
+
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queue_depth": max(self.in_flight - max(self.workers, 1), 0),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "total_seconds": self.total_seconds,
+        }
+
+    def _get_pool(self):
+        # A pool inherited across fork() (e.g. gunicorn --preload) can't be
+        # used by the child, so each process builds its own.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+
+            return self._pool
+
+    def _run(self, func, *args):
+        # init_app may swap in a new semaphore while a job is running.
+        slots = self._slots
+
+        if not slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+
+        with self._lock:
+            self.in_flight += 1
+
+        start = time.perf_counter()
+        timed_out = False
+
+        try:
+            if not self.workers:
+                try:
+                    return func(*args)
+                finally:
+                    self._release(slots)
+
+            try:
+                future = self._get_pool().submit(func, *args)
+            except Exception:
+                self._release(slots)
+                raise
+
+            # The slot is held until the job is really over, not just until
+            # the caller stops waiting, so PASSWORD_HASH_MAX_PENDING bounds
+            # the work in the pool even when callers time out.
+            future.add_done_callback(lambda future: self._release(slots))
+
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                # Drops the job if it hasn't started; a running one can't
+                # be stopped and keeps its slot until it finishes.
+                future.cancel()
+                timed_out = True
+                raise PasswordHasherBusy()
+
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                if timed_out:
+                    self.timeouts += 1
+                else:
+                    self.completed += 1
+
+                self.total_seconds += elapsed
+            hash_finished.send(self, seconds=elapsed)
+
+    def _release(self, slots):
+        with self._lock:
+            self.in_flight -= 1
+        slots.release()
@@ -0,0 +1,55 @@
+"""Count the SQL statements run against the Warbler database.
+
+Mostly for tests, to catch pages whose query count creeps up (N+1 loads):
+
+    class MyTestCase(QueryCountMixin, TestCase):
+        def test_homepage(self):
+            with self.assertMaxQueries(5):
+                self.client.get("/")
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    """Context manager that records every statement run on `db.engine`."""
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        if self.engine is None:
+            self.engine = db.engine
+
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class QueryCountMixin:
+    """TestCase mixin adding assertMaxQueries."""
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        """Fail if the block runs more than `limit` SQL statements."""
+
+        with QueryCounter() as counter:
+            yield counter
+
+        if counter.count > limit:
+            self.fail(f"{counter.count} queries run, expected at most {limit}:\n"
+                      + "\n".join(counter.statements))
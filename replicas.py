@@ -0,0 +1,117 @@
+"""Send read-only pages' queries to read replicas.
+
+Replicas are Flask-SQLAlchemy binds named replica0, replica1, ... (app.py
+builds them from DATABASE_REPLICA_URLS). Views that only read are marked
+with @read_only, under @app.route:
+
+    @app.route('/users/<int:user_id>')
+    @read_only
+    def users_show(user_id):
+        ...
+
+A GET of such a view picks one replica for the whole request, and every
+query the session runs goes there. Anything else, and any flush, uses
+the primary.
+
+Replicas lag a little behind the primary, so someone who has just changed
+something (any successful POST, PUT or DELETE) reads from the primary for
+DB_READ_YOUR_WRITES seconds afterwards: their new message, follow or like
+shows up on the next page they load. The deadline rides in the session
+cookie, so it holds whichever worker serves that page.
+
+Configuration (app.config, set from the environment in app.py):
+
+- SQLALCHEMY_BINDS: the replicas, as replica<n> binds; none means every
+  query goes to the primary.
+- DB_READ_YOUR_WRITES: seconds to read from the primary after a write.
+"""
+
+import random
+import time
+
+from flask import g, request, session, current_app, has_request_context
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import orm
+
+import db_pool
+
+WRITE_METHODS = ("POST", "PUT", "DELETE")
+
+PRIMARY_UNTIL_KEY = "_read_primary_until"
+
+
+def read_only(view):
+    """Mark `view` as safe to serve from a replica."""
+
+    view.read_only = True
+    return view
+
+
+def replica_binds():
+    return sorted(key for key in current_app.config.get('SQLALCHEMY_BINDS') or {}
+                  if key.startswith('replica'))
+
+
+def current_replica():
+    """The bind this request reads from, or None for the primary."""
+
+    if has_request_context():
+        return g.get('_replica')
+
+    return None
+
+
+def choose_replica():
+    """before_request hook picking a replica for read-only GETs."""
+
+    g._replica = None
+
+    if request.method not in ("GET", "HEAD"):
+        return
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    if not getattr(view, 'read_only', False):
+        return
+
+    if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+        return
+
+    binds = replica_binds()
+
+    if binds:
+        g._replica = random.choice(binds)
+
+
+def remember_write(response):
+    """after_request hook starting the read-your-writes window."""
+
+    if request.method in WRITE_METHODS and response.status_code < 400:
+        window = current_app.config.get('DB_READ_YOUR_WRITES', 5)
+        session[PRIMARY_UNTIL_KEY] = time.time() + window
+
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from the request's replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = current_replica()
+
+        if replica is not None and not self._flushing:
+            return get_state(self.app).db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class SQLAlchemy(db_pool.SQLAlchemy):
+    """Flask-SQLAlchemy with pooled engines and replica routing."""
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.before_request(choose_replica)
+        app.after_request(remember_write)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,168 @@
+"""User and message search for Warbler.
+
+On PostgreSQL, username matching is served by a pg_trgm GIN index
+(ix_users_username_trgm, see models.py), which handles both `%term%` and
+`term%` patterns without scanning the users table, and results are ranked
+by trigram similarity.
+
+Message text is searched with PostgreSQL full-text search, backed by a GIN
+expression index over to_tsvector(text) (ix_messages_text_fts) that the
+database keeps current on every insert.
+
+Other databases (SQLite in tests) fall back to plain LIKE matching with a
+simpler ranking.
+"""
+
+from models import db, User, Message
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# Must match the configuration in the ix_messages_text_fts index.
+TEXT_SEARCH_CONFIG = 'english'
+
+# Relevance-ordered message results can't use a keyset cursor, so they are
+# paged by offset. Only the newest MAX_RELEVANCE_RESULTS matches are ranked,
+# so a common word costs the same as a rare one.
+MAX_RELEVANCE_RESULTS = 1000
+
+
+def _is_postgres():
+    return db.engine.dialect.name == "postgresql"
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in user input so they match literally."""
+
+    return (term
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def username_filter(term, prefix=False):
+    """Filter clause matching usernames containing (or starting with) `term`.
+
+    Case-insensitive.
+    """
+
+    pattern = escape_like(term) + "%"
+
+    if not prefix:
+        pattern = "%" + pattern
+
+    return User.username.ilike(pattern, escape="\\")
+
+
+def ranking(term):
+    """ORDER BY clauses for search results: best matches first.
+
+    Prefix matches come first, then (on PostgreSQL) higher trigram
+    similarity, or (elsewhere) shorter usernames.
+    """
+
+    is_prefix = db.case([(username_filter(term, prefix=True), 0)], else_=1)
+
+    if _is_postgres():
+        closeness = db.func.similarity(User.username, term).desc()
+    else:
+        closeness = db.func.length(User.username)
+
+    return [is_prefix, closeness, User.id]
+
+
+def search_users(term, limit=SEARCH_LIMIT, prefix=False, exclude_ids=()):
+    """Return up to `limit` users matching `term`, best matches first.
+
+    `prefix` restricts matches to usernames starting with `term` (for
+    typeahead); `exclude_ids` are never returned (e.g. the viewer and
+    users blocking them).
+    """
+
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+    query = User.query.filter(username_filter(term, prefix=prefix))
+
+    if exclude_ids:
+        query = query.filter(User.id.notin_(exclude_ids))
+
+    return query.order_by(*ranking(term)).limit(limit).all()
+
+
+def message_text_filter(term):
+    """Filter clause matching messages whose text contains every word of `term`."""
+
+    if _is_postgres():
+        document = db.func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+        query = db.func.plainto_tsquery(TEXT_SEARCH_CONFIG, term)
+        return document.op('@@')(query)
+
+    return db.and_(*[Message.text.ilike(f"%{escape_like(word)}%", escape="\\")
+                     for word in term.split()])
+
+
+def message_relevance(term):
+    """Relevance score expression for `term`, higher is better.
+
+    Only meaningful on PostgreSQL; elsewhere every match scores the same.
+    """
+
+    if _is_postgres():
+        document = db.func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+        query = db.func.plainto_tsquery(TEXT_SEARCH_CONFIG, term)
+        return db.func.ts_rank(document, query)
+
+    return db.literal(0)
+
+
+def search_messages(term, exclude_user_ids=()):
+    """Query for messages matching `term`, authors loaded, not yet ordered.
+
+    `exclude_user_ids` drops messages by those users (e.g. users blocking
+    the viewer). Callers order and page it: by (timestamp, id) through
+    pagination.keyset_page, or by message_relevance(term).
+    """
+
+    query = (Message
+             .query
+             .filter(message_text_filter(term))
+             .options(db.joinedload(Message.user)))
+
+    if exclude_user_ids:
+        query = query.filter(Message.user_id.notin_(exclude_user_ids))
+
+    return query
+
+
+def relevance_page(query, term, page, per_page):
+    """Return (messages, next_page) for page `page` (1-based) by relevance.
+
+    Only the newest MAX_RELEVANCE_RESULTS matches are ranked; ties are
+    broken newest first.
+    """
+
+    offset = (max(page, 1) - 1) * per_page
+
+    if offset >= MAX_RELEVANCE_RESULTS:
+        return [], None
+
+    # Take the candidates off the text index newest first, and compute
+    # ts_rank for those alone rather than for every match.
+    candidates = (query
+                  .enable_eagerloads(False)
+                  .with_entities(Message.id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(MAX_RELEVANCE_RESULTS))
+
+    rows = (query
+            .filter(Message.id.in_(candidates))
+            .order_by(message_relevance(term).desc(),
+                      Message.timestamp.desc(),
+                      Message.id.desc())
+            .offset(offset)
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) <= per_page or offset + per_page >= MAX_RELEVANCE_RESULTS:
+        return rows[:per_page], None
+
+    return rows[:per_page], max(page, 1) + 1
@@ -1,20 +1,50 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows, Likes
+Streams each CSV into its table (COPY on PostgreSQL), with secondary
+indexes and foreign keys rebuilt after the load. Run with an alternative
+directory of CSVs, e.g. from generator/create_csvs.py, as:
 
+    python seed.py path/to/csvs
+
+Sharded output (users-00000.csv, users-00001.csv, ...) is loaded file by
+file in order.
+"""
+
+import glob
+import os
+import sys
+
+import migrate
+from app import app, db
+from loader import load_csv, deferred_constraints, resync_sequences
+from models import User, Timeline
+
+csv_dir = sys.argv[1] if len(sys.argv) > 1 else 'generator'
+
+# Bulk loads may rightly run for a long time.
+app.config['DB_STATEMENT_TIMEOUT'] = 0
 
 db.drop_all()
 db.create_all()
+# create_all() builds the current schema: no migration needs to run on it.
+migrate.stamp(db.engine)
+
+with deferred_constraints():
+    for table_name in ['users', 'messages', 'follows', 'likes', 'blocks']:
+        paths = sorted(glob.glob(os.path.join(csv_dir, f'{table_name}-*.csv')))
+        single = os.path.join(csv_dir, f'{table_name}.csv')
+
+        if os.path.exists(single):
+            paths.insert(0, single)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+        for path in paths:
+            load_csv(table_name, path)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+resync_sequences()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+# Bulk loads skip fan-out and the counter updates, so build every user's
+# timeline and counters now.
+User.recount()
+Timeline.rebuild_all()
 
 db.session.commit()
@@ -1,46 +1,55 @@
 $(function () {
+  // The buttons call the JSON API (see the "Like/follow/block toggles" routes
+  // in app.py) and then show whatever state the server says is current.
+
+  function setFollowing($link, following) {
+    $link.toggleClass('stop-following btn-primary text-white', following)
+    $link.toggleClass('start-following btn-outline-primary text-primary', !following)
+    $link.text(following ? 'Unfollow' : 'Follow')
+  }
+
+  function setBlocking($link, blocking) {
+    $link.toggleClass('stop-blocking btn-danger text-white', blocking)
+    $link.toggleClass('start-blocking btn-outline-danger text-danger', !blocking)
+    $link.text(blocking ? 'Unblock' : 'Block')
+  }
+
+  function showFollowersCount(userId, count) {
+    $(`a[href="/users/${userId}/followers"]`).text(count)
+  }
+
   $('.follow-wrapper').on('click', '.stop-following, .start-following', async function (e) {
     e.preventDefault()
-    $link = $(e.target)
+    let $link = $(e.target)
+    let method = $link.hasClass('stop-following') ? 'delete' : 'put'
 
-    let route = $link.hasClass('stop-following') ? 'stop-following' : 'follow';
-    let followText = $link.hasClass('stop-following') ? 'Follow' : 'Unfollow';
-    
-    let response = await axios.post(`/users/${route}/${e.target.id}`)
+    let response = await axios({ method, url: `/api/users/${e.target.id}/follow` })
 
-    if (response.status === 200) {
-      $link.toggleClass('start-following stop-following btn-primary btn-outline-primary text-primary text-white')
-      $link.text(followText)
-    }
+    setFollowing($link, response.data.following)
+    showFollowersCount(e.target.id, response.data.user.followers_count)
   })
 
 
   $('.list-group-item').on('click', '.like-btn', async function (e) {
     e.preventDefault()
-    let response = await axios.post(`/likes/${e.target.closest("a").id}/update`)
+    let $link = $(e.target).closest('a')
+    let method = $link.hasClass('likes') ? 'delete' : 'put'
 
-    if (response.status === 200) {
-      $(e.target).closest("a").toggleClass('likes not-likes')
-    }
+    let response = await axios({ method, url: `/api/messages/${$link.attr('id')}/like` })
+
+    $link.toggleClass('likes', response.data.liked)
+    $link.toggleClass('not-likes', !response.data.liked)
   });
 
   $('.follow-wrapper').on('click', '.stop-blocking, .start-blocking', async function (e) {
     e.preventDefault()
-    $link = $(e.target)
-
-    let route = $link.hasClass('stop-blocking') ? 'unblock' : 'block';
-    let blockText = $link.hasClass('stop-blocking') ? 'Block' : 'Unblock';
-
-    let response = await axios.post(`/users/${route}/${e.target.id}`)
+    let $link = $(e.target)
+    let method = $link.hasClass('stop-blocking') ? 'delete' : 'put'
 
-    if (response.status === 200) {
-      $link.toggleClass('start-blocking stop-blocking btn-danger btn-outline-danger text-danger text-white')
-      $link.text(blockText)
+    let response = await axios({ method, url: `/api/users/${e.target.id}/block` })
 
-      if(route === 'block' && $('.follow-btn-lg').first().text() === 'Unfollow') {
-        $('.follow-btn-lg').toggleClass('start-following stop-following btn-primary btn-outline-primary text-primary text-white')
-        $('.follow-btn-lg').text('Follow')
-      }
-    }
+    setBlocking($link, response.data.blocking)
+    setFollowing($('.follow-btn-lg'), response.data.following)
+    showFollowersCount(e.target.id, response.data.user.followers_count)
   })
-});
\ No newline at end of file
+});
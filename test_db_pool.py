@@ -0,0 +1,106 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_db_pool.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
+
+import db_pool
+from metrics import Metrics
+
+
+class DBPoolTestCase(TestCase):
+    """Test pool settings, monitoring and fork safety."""
+
+    def setUp(self):
+        self.engine = create_engine(
+            'sqlite://', poolclass=db_pool.monitored_pool('test'),
+            pool_size=1, max_overflow=0, pool_timeout=0.05,
+            connect_args={'check_same_thread': False})
+        self.pool = self.engine.pool
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_engine_options(self):
+        """ Do the DB_* settings become create_engine() arguments? """
+
+        options = db_pool.engine_options(
+            {'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 2, 'DB_POOL_TIMEOUT': 1.5,
+             'DB_POOL_RECYCLE': 600, 'DB_POOL_PRE_PING': True,
+             'DB_CONNECT_TIMEOUT': 4, 'DB_STATEMENT_TIMEOUT': 2000},
+            make_url('postgresql://db.example.com/warbler'))
+
+        self.assertEqual(options['poolclass'].name, 'db.example.com/warbler')
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['pool_timeout'], 1.5)
+        self.assertEqual(options['pool_recycle'], 600)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'connect_timeout': 4, 'options': '-c statement_timeout=2000'})
+
+    def test_saturation_and_timeouts(self):
+        """ Are checkouts, saturation and timeouts counted and exposed? """
+
+        connection = self.engine.connect()
+        stats = self.pool.stats()
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['saturation'], 1.0)
+
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+
+        connection.close()
+        self.engine.connect().close()
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.05)
+
+        text = Metrics(pools=db_pool.pools).render()
+        self.assertIn('warbler_db_pool_timeouts_total{pool="test"} 1', text)
+        self.assertIn('warbler_db_pool_capacity{pool="test"} 1', text)
+
+    def test_reset_after_fork(self):
+        """ Does a forked process start with an empty pool of its own? """
+
+        self.engine.connect().close()
+        inherited = self.pool._pool.queue[0]
+
+        # Pretend this process was forked from the one that opened it
+        self.pool.pid = -1
+        inherited.info['pid'] = -1
+        self.assertNotIn(self.pool, list(db_pool.pools))
+
+        db_pool.pools.reset_after_fork()
+
+        self.assertEqual(self.pool.pid, os.getpid())
+        self.assertEqual(self.pool.checkouts, 0)
+        self.assertEqual(self.pool.checkedin(), 0)
+        self.assertIn(inherited, db_pool._inherited)
+
+        self.engine.connect().close()
+        self.assertEqual(self.pool._pool.queue[0].info['pid'], os.getpid())
+
+    def test_refuse_other_process_connection(self):
+        """ Is a connection opened by another process never handed out? """
+
+        self.engine.connect().close()
+        inherited = self.pool._pool.queue[0]
+        dbapi_connection = inherited.connection
+        inherited.info['pid'] = -1
+
+        self.engine.connect().close()
+
+        self.assertIn(dbapi_connection, db_pool._inherited)
+        self.assertIsNot(self.pool._pool.queue[0].connection, dbapi_connection)
+        self.assertEqual(self.pool._pool.queue[0].info['pid'], os.getpid())
@@ -1,9 +1,10 @@
 """ Message model tests"""
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, utcnow, User, Message, Follows, Timeline
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
@@ -13,6 +14,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from app import app, session, CURR_USER_KEY
 app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CACHE_TTL'] = 0
 
 
 class MessageModelTestCase(TestCase):
@@ -66,6 +68,74 @@ class MessageModelTestCase(TestCase):
 
         self.assertEqual(len(self.u1.messages), 1)
         self.assertEqual(len(self.u2.messages), 1)
-    
 
-       
\ No newline at end of file
+    def test_message_timestamps(self):
+        """ Is each message stamped by the database when it's written? """
+
+        first = Message(text="first", user_id=self.u1.id)
+        db.session.add(first)
+        db.session.flush()
+        Timeline.fan_out(first)
+
+        # Compare against the database's clock in the same transaction
+        now = db.session.query(utcnow()).scalar()
+        self.assertLessEqual(first.timestamp, now)
+        self.assertLess(now - first.timestamp, timedelta(minutes=1))
+
+        # An explicit timestamp is kept as given
+        earlier = Message(text="earlier", user_id=self.u1.id,
+                          timestamp=datetime(2020, 1, 1))
+        db.session.add(earlier)
+        db.session.commit()
+
+        self.assertEqual(earlier.timestamp, datetime(2020, 1, 1))
+        self.assertGreater(first.timestamp, earlier.timestamp)
+        entry = Timeline.query.filter_by(message_id=first.id).one()
+        self.assertEqual(entry.timestamp, first.timestamp)
+
+    def test_timeline_trim(self):
+        """ Are timelines trimmed to TIMELINE_SIZE, every TIMELINE_SIZE posts? """
+
+        self.u2.following.append(self.u1)
+        db.session.commit()
+        Timeline.rebuild_all()
+
+        size = Timeline.TIMELINE_SIZE
+        Timeline.TIMELINE_SIZE = 2
+
+        try:
+            # Message 101 isn't a trimming post, so u2's timeline runs over
+            second = Message(id=101, text="second", user_id=self.u1.id)
+            db.session.add(second)
+            db.session.flush()
+            Timeline.fan_out(second)
+            self.assertEqual(Timeline.query.filter_by(user_id=self.u2.id).count(), 3)
+
+            third = Message(id=102, text="third", user_id=self.u1.id)
+            db.session.add(third)
+            db.session.flush()
+            Timeline.fan_out(third)
+            db.session.commit()
+        finally:
+            Timeline.TIMELINE_SIZE = size
+
+        u1_feed = {message.text for message in Timeline.feed_query(self.u1.id)}
+        u2_feed = {message.text for message in Timeline.feed_query(self.u2.id)}
+
+        self.assertEqual(u1_feed, {"second", "third"})
+        self.assertEqual(u2_feed, {"second", "third"})
+
+    def test_timeline_rebuild_all(self):
+        """ Does a bulk timeline rebuild cover own and followed messages? """
+
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        Timeline.rebuild_all()
+        db.session.commit()
+
+        u1_feed = {message.text for message in Timeline.feed_query(self.u1.id)}
+        u2_feed = {message.text for message in Timeline.feed_query(self.u2.id)}
+
+        self.assertEqual(u1_feed, {"test message number one", "test message number two"})
+        self.assertEqual(u2_feed, {"test message number two"})
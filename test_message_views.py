@@ -1,9 +1,13 @@
 """ Message model tests"""
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from sqlalchemy import exc
+
+from models import db, User, Message, Follows, Timeline
+from query_counter import QueryCountMixin
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
@@ -11,16 +15,19 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, session, CURR_USER_KEY
+from fragments import fragment_cache
 app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CACHE_TTL'] = 0
 
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(QueryCountMixin, TestCase):
     """ Test for message model"""
 
     def setUp(self):
         """Create test client, add sample data."""
         app.config['SECRET_KEY'] = 'secret'
+        fragment_cache.clear()
         db.create_all()
         User.query.delete()
         Message.query.delete()
@@ -76,6 +83,10 @@ class MessageModelTestCase(TestCase):
             self.assertIn("<p>This is a new test message</p>", html)
             self.assertIn("<p>test message number one</p>", html)
 
+            # messages_count starts at 0 since setUp bypasses the view
+            user = User.query.filter_by(username="testuser").first()
+            self.assertEqual(user.messages_count, 1)
+
 
     def test_new_blank_message(self):
         """ Do we correctly prevent a user from posting a blank message? """
@@ -155,4 +166,292 @@ class MessageModelTestCase(TestCase):
             resp = self.client.post(f"/likes/{message1.id}/update", follow_redirects=True)
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized", html)
\ No newline at end of file
+            self.assertIn("Access unauthorized", html)
+
+    def test_timeline_fan_out(self):
+        """ Do new messages reach followers' home timelines, and leave on unfollow? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            self.client.post(f"/users/follow/{u1_id}")
+
+            # Following backfills the existing messages of user 1
+            resp = self.client.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>test message number one</p>", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            self.client.post("/messages/new", data={"text": "fan out to followers"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = self.client.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("<p>fan out to followers</p>", html)
+
+            # Unfollowing purges user 1's messages from the timeline
+            self.client.post(f"/users/stop-following/{u1_id}")
+
+            resp = self.client.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertNotIn("<p>fan out to followers</p>", html)
+            self.assertEqual(Timeline.query.filter_by(user_id=u2_id,
+                                                      author_id=u1_id).count(), 0)
+
+    def test_user_messages_pagination(self):
+        """ Can we page through a user's messages with the 'before' cursor? """
+        u1_id = self.u1.id
+        start = datetime(2020, 1, 1)
+
+        db.session.add_all([Message(text=f"paged message {i}",
+                                    user_id=u1_id,
+                                    timestamp=start + timedelta(minutes=i))
+                            for i in range(150)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get(f"/api/users/{u1_id}/messages")
+            first = resp.get_json()
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(first["messages"]), 100)
+            self.assertIsNotNone(first["next"])
+
+            resp = self.client.get(f"/api/users/{u1_id}/messages?before={first['next']}")
+            second = resp.get_json()
+            self.assertEqual(len(second["messages"]), 51)
+            self.assertIsNone(second["next"])
+
+            # Pages don't overlap, and together they cover every message
+            ids = [m["id"] for m in first["messages"] + second["messages"]]
+            self.assertEqual(len(set(ids)), 151)
+
+            resp = self.client.get(f"/users/{u1_id}?before={first['next']}")
+            html = resp.get_data(as_text=True)
+            # "test message number one" is newest, so page two starts at 50
+            self.assertIn("<p>paged message 50</p>", html)
+            self.assertNotIn("<p>paged message 51</p>", html)
+
+    def test_homepage_query_count(self):
+        """ Does the homepage load message authors without a query per message? """
+        u1_id = self.u1.id
+
+        authors = [User.signup(email=f"author{i}@test.com",
+                               username=f"author{i}",
+                               password="HASHED_PASSWORD",
+                               image_url="")
+                   for i in range(10)]
+        db.session.add_all(authors)
+        db.session.commit()
+
+        db.session.add_all([Message(text=f"by {author.username}", user_id=author.id)
+                            for author in authors])
+        db.session.commit()
+        author_ids = [author.id for author in authors]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            # Following backfills each author's message into the timeline
+            for author_id in author_ids:
+                self.client.post(f"/users/follow/{author_id}")
+
+            # Start from an empty identity map, like a fresh request would
+            db.session.remove()
+
+            with self.assertMaxQueries(4):
+                resp = self.client.get("/")
+
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count("<p>by author"), 10)
+
+    def test_message_search(self):
+        """ Can we search messages, without seeing users who block us? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get("/messages/search?q=number two")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>test message number two</p>", html)
+            self.assertNotIn("<p>test message number one</p>", html)
+
+            resp = self.client.get("/api/messages/search?q=message&sort=relevance")
+            self.assertEqual(len(resp.get_json()["messages"]), 2)
+
+            # User 2 blocks user 1; user 1 no longer finds user 2's messages
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+            self.client.post(f"/users/block/{u1_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get("/api/messages/search?q=message")
+            texts = [message["text"] for message in resp.get_json()["messages"]]
+            self.assertEqual(texts, ["test message number one"])
+
+    def test_request_metrics(self):
+        """ Are per-endpoint query counts exposed via /metrics and Server-Timing? """
+        u1_id = self.u1.id
+        app.config['SERVER_TIMING'] = True
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u1_id
+
+                resp = self.client.get("/")
+                self.assertIn('desc="', resp.headers["Server-Timing"])
+                self.assertIn("tpl;dur=", resp.headers["Server-Timing"])
+        finally:
+            app.config['SERVER_TIMING'] = False
+
+        # Metrics are only served with the configured token
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        app.config['METRICS_TOKEN'] = 'scraper'
+
+        try:
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            resp = self.client.get("/metrics",
+                                   headers={"Authorization": "Bearer scraper"})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+        text = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('warbler_db_queries_total{endpoint="homepage"}', text)
+        self.assertIn('warbler_request_duration_seconds_count{endpoint="homepage"}', text)
+        self.assertIn('warbler_slowest_query_seconds{endpoint="homepage",statement="SELECT', text)
+
+    def test_failed_query_timing(self):
+        """ Does a failed statement leave no query start time behind? """
+
+        connection = db.session.connection()
+
+        with self.assertRaises(exc.DBAPIError):
+            connection.execute("SELECT * FROM no_such_table")
+
+        self.assertEqual(connection.info.get('query_start_time'), [])
+
+    def test_message_card_fragment_cache(self):
+        """ Are message cards shared between viewers, with their own like state? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+        message_id = Message.query.filter_by(user_id=u2_id).one().id
+
+        u3 = User.signup(email="test3@test.com",
+                         username="testuser3",
+                         password="HASHED_PASSWORD",
+                         image_url="")
+        db.session.add(u3)
+        db.session.commit()
+        u3_id = u3.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            self.client.post(f"/users/follow/{u2_id}")
+            self.client.post(f"/likes/{message_id}/update")
+
+            misses = fragment_cache.misses
+            html = self.client.get("/").get_data(as_text=True)
+            self.assertEqual(fragment_cache.misses, misses + 1)
+            self.assertIn("<p>test message number two</p>", html)
+            self.assertIn(f"<a id=\"{message_id}\" class='like-btn likes'>", html)
+            self.assertNotIn("slot:like", html)
+
+            # User 3 gets the same card from the cache, with their own like state
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u3_id
+
+            self.client.post(f"/users/follow/{u2_id}")
+
+            hits = fragment_cache.hits
+            html = self.client.get("/").get_data(as_text=True)
+            self.assertEqual(fragment_cache.hits, hits + 1)
+            self.assertIn("<p>test message number two</p>", html)
+            self.assertIn(f"<a id=\"{message_id}\" class='like-btn not-likes'>", html)
+
+    def test_api_like(self):
+        """ Is the JSON like toggle idempotent? """
+        u1_id = self.u1.id
+        message_id = Message.query.filter_by(user_id=self.u2.id).one().id
+        own_message_id = Message.query.filter_by(user_id=u1_id).one().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            for _ in range(2):
+                resp = self.client.put(f"/api/messages/{message_id}/like")
+                self.assertEqual(resp.get_json(), {"liked": True, "likes_count": 1})
+
+            for _ in range(2):
+                resp = self.client.delete(f"/api/messages/{message_id}/like")
+                self.assertEqual(resp.get_json(), {"liked": False, "likes_count": 0})
+
+            resp = self.client.put(f"/api/messages/{own_message_id}/like")
+            self.assertEqual(resp.status_code, 403)
+
+    def test_user_likes_page(self):
+        """ Are a user's likes paged, and hidden from users they block? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        messages = [Message(text=f"liked message {i}", user_id=u2_id)
+                    for i in range(120)]
+        db.session.add_all(messages)
+        db.session.commit()
+        message_ids = [message.id for message in messages]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            for message_id in message_ids:
+                self.client.put(f"/api/messages/{message_id}/like")
+
+            resp = self.client.get(f"/users/{u1_id}/likes")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count("like-btn likes"), 100)
+            self.assertIn(f'/users/{u1_id}/likes">120</a>', html)
+            self.assertIn("<p>liked message 119</p>", html)
+            self.assertNotIn("<p>liked message 19</p>", html)
+
+            resp = self.client.get(f"/users/{u1_id}/likes?before={message_ids[20]}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count("like-btn likes"), 20)
+            self.assertIn("<p>liked message 19</p>", html)
+
+            # User 2 blocks user 1: user 1 no longer sees user 2's messages
+            # among their likes
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            self.client.post(f"/users/block/{u1_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get(f"/users/{u1_id}/likes")
+            html = resp.get_data(as_text=True)
+            self.assertIn(f'/users/{u1_id}/likes">0</a>', html)
+            self.assertNotIn("liked message", html)
@@ -0,0 +1,195 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrate.py
+
+
+import io
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrate
+
+FIRST = '''"""Create the widgets table."""
+
+
+def upgrade(m):
+    m.execute("CREATE TABLE widgets (id INTEGER PRIMARY KEY, size INTEGER)")
+    m.execute("INSERT INTO widgets (id, size) VALUES (1, 1), (2, 2), (3, 3), (4, 4)")
+'''
+
+SECOND = '''"""Count widget sizes and index them."""
+
+
+def upgrade(m):
+    m.add_column('widgets', 'doubled', "INTEGER NOT NULL DEFAULT 0")
+    m.add_column('widgets', 'doubled', "INTEGER NOT NULL DEFAULT 0")
+    m.backfill('widgets', "doubled = size * 2", where="size > 1", batch_size=2)
+    m.create_index('ix_widgets_doubled', 'widgets', 'doubled')
+    m.create_index('ix_widgets_doubled', 'widgets', 'doubled')
+'''
+
+
+class MigrateTestCase(TestCase):
+    """Test the migration runner and its helpers."""
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.engine = db.engine
+        self.directory = tempfile.TemporaryDirectory()
+        self.drop()
+
+        with open(os.path.join(self.directory.name, '0001_widgets.py'), 'w') as script:
+            script.write(FIRST)
+
+    def tearDown(self):
+        self.drop()
+        self.directory.cleanup()
+        self.context.pop()
+
+    def drop(self):
+        with self.engine.begin() as connection:
+            connection.execute("DROP TABLE IF EXISTS widgets")
+            connection.execute("DROP TABLE IF EXISTS schema_migrations")
+
+    def test_upgrade(self):
+        """ Do pending migrations run once each, in order, with their helpers? """
+
+        out = io.StringIO()
+        self.assertEqual(migrate.upgrade(self.engine, self.directory.name, out), [1])
+        self.assertIn("0001_widgets.py: Create the widgets table.", out.getvalue())
+
+        with open(os.path.join(self.directory.name, '0002_doubled.py'), 'w') as script:
+            script.write(SECOND)
+
+        self.assertEqual(list(migrate.pending(self.engine, self.directory.name)), [2])
+        self.assertEqual(migrate.upgrade(self.engine, self.directory.name, out), [2])
+        self.assertEqual(migrate.upgrade(self.engine, self.directory.name, out), [])
+        self.assertIn("backfilled 3 widgets rows", out.getvalue())
+
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                "SELECT size, doubled FROM widgets ORDER BY id").fetchall()
+
+        self.assertEqual([tuple(row) for row in rows], [(1, 0), (2, 4), (3, 6), (4, 8)])
+        self.assertIn('ix_widgets_doubled',
+                      {index['name'] for index in db.inspect(self.engine).get_indexes('widgets')})
+
+    def test_stamp(self):
+        """ Does stamping record migrations without running them? """
+
+        migrate.stamp(self.engine, self.directory.name)
+
+        self.assertEqual(migrate.applied(self.engine), {1})
+        self.assertEqual(migrate.upgrade(self.engine, self.directory.name), [])
+        self.assertFalse(self.engine.has_table('widgets'))
+
+
+# What migrations/ adds to a database from before them.
+MIGRATED_INDEXES = ['ix_messages_user_id_timestamp', 'ix_messages_timestamp',
+                    'ix_follows_user_following_id', 'ix_blocks_user_blocking_id',
+                    'ix_users_username_trgm', 'ix_messages_text_fts']
+MIGRATED_USER_COLUMNS = ['messages_count', 'following_count', 'followers_count',
+                         'likes_count', 'updated_at']
+
+
+class MigrationScriptsTestCase(TestCase):
+    """Run the real migrations/ scripts on a database from before them."""
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.engine = db.engine
+
+        if self.engine.dialect.name != "postgresql":
+            self.context.pop()
+            self.skipTest("the migrations in migrations/ are PostgreSQL-only")
+
+        db.drop_all()
+        db.create_all()
+
+        # Take the current schema back to what the migrations start from
+        with self.engine.begin() as connection:
+            connection.execute("DROP TABLE IF EXISTS schema_migrations")
+            connection.execute("DROP TABLE timelines")
+
+            for index in MIGRATED_INDEXES:
+                connection.execute(f"DROP INDEX {index}")
+
+            connection.execute("ALTER TABLE users " + ", ".join(
+                f"DROP COLUMN {column}" for column in MIGRATED_USER_COLUMNS))
+            connection.execute("ALTER TABLE messages ALTER COLUMN timestamp DROP DEFAULT")
+
+            connection.execute(
+                "INSERT INTO users (id, email, username, password) VALUES "
+                "(1, 'test1@test.com', 'testuser1', 'HASHED_PASSWORD'), "
+                "(2, 'test2@test.com', 'testuser2', 'HASHED_PASSWORD')")
+
+            # Messages 1 and 3 carry their worker's start time
+            connection.execute(
+                "INSERT INTO messages (id, text, timestamp, user_id) VALUES "
+                "(1, 'one', '2020-01-01', 1), "
+                "(2, 'two', '2020-01-02', 2), "
+                "(3, 'three', '2020-01-01', 1)")
+            connection.execute(
+                "INSERT INTO follows (user_being_followed_id, user_following_id) "
+                "VALUES (1, 2)")
+
+    def tearDown(self):
+        with self.engine.begin() as connection:
+            connection.execute("DROP TABLE IF EXISTS schema_migrations")
+
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_upgrade_to_current_schema(self):
+        """ Do the migrations bring an old database up to the current models? """
+
+        out = io.StringIO()
+        self.assertEqual(migrate.upgrade(self.engine, out=out), [1, 2])
+        self.assertEqual(migrate.applied(self.engine), {1, 2})
+        self.assertEqual(migrate.upgrade(self.engine, out=out), [])
+
+        with self.engine.connect() as connection:
+            indexes = {row.indexname for row in connection.execute(
+                "SELECT indexname FROM pg_indexes WHERE schemaname = 'public'")}
+
+            counts = connection.execute(
+                "SELECT messages_count, following_count, followers_count "
+                "FROM users ORDER BY id").fetchall()
+
+            timestamps = connection.execute(
+                "SELECT timestamp FROM messages ORDER BY id").fetchall()
+
+            timelines = connection.execute(
+                "SELECT user_id, count(*) FROM timelines "
+                "GROUP BY user_id ORDER BY user_id").fetchall()
+
+        self.assertLessEqual(set(MIGRATED_INDEXES), indexes)
+        self.assertLessEqual({'ix_timelines_user_id_timestamp',
+                              'ix_timelines_user_id_author_id'}, indexes)
+
+        self.assertEqual([tuple(row) for row in counts], [(2, 0, 1), (1, 1, 0)])
+
+        # The stale message moves up to the newest time before it
+        self.assertEqual([row.timestamp for row in timestamps],
+                         [datetime(2020, 1, 1), datetime(2020, 1, 2),
+                          datetime(2020, 1, 2)])
+
+        self.assertEqual([tuple(row) for row in timelines], [(1, 2), (2, 3)])
+
+        # New messages are stamped by the database again
+        message = Message(id=4, text="four", user_id=1)
+        db.session.add(message)
+        db.session.commit()
+        self.assertIsNotNone(message.timestamp)
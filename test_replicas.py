@@ -0,0 +1,86 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from fragments import fragment_cache
+from replicas import PRIMARY_UNTIL_KEY
+app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CACHE_TTL'] = 0
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test that read-only pages read from the replica, except after a write."""
+
+    def setUp(self):
+        app.config['SECRET_KEY'] = 'secret'
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica0': "postgresql:///warbler-test-replica"}
+        fragment_cache.clear()
+
+        db.create_all()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.replica = db.get_engine(app, 'replica0')
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+
+        # The replica hasn't caught up with user 2's new bio yet
+        users = [dict(id=1, email="test1@test.com", username="testuser1",
+                      password="HASHED_PASSWORD", bio="bio one"),
+                 dict(id=2, email="test2@test.com", username="testuser2",
+                      password="HASHED_PASSWORD", bio="old bio")]
+        db.session.execute(User.__table__.insert(), [
+            dict(users[0]), dict(users[1], bio="new bio")])
+        db.session.commit()
+        self.replica.execute(User.__table__.insert(), users)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.metadata.drop_all(self.replica)
+        db.drop_all()
+        app.config['SQLALCHEMY_BINDS'] = {}
+
+    def test_read_only_pages_use_replica(self):
+        """ Do profile pages read the replica, and writes the primary? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            html = self.client.get("/users/2").get_data(as_text=True)
+            self.assertIn("<p>old bio</p>", html)
+
+            # Editing pages and writes go to the primary
+            self.client.post("/users/follow/2")
+            self.assertEqual(Follows.query.count(), 1)
+
+            with self.replica.connect() as connection:
+                self.assertEqual(
+                    connection.execute("SELECT count(*) FROM follows").scalar(), 0)
+
+            # Right after writing, the user reads their own writes
+            html = self.client.get("/users/2").get_data(as_text=True)
+            self.assertIn("<p>new bio</p>", html)
+
+            with c.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = time.time() - 1
+
+            html = self.client.get("/users/2").get_data(as_text=True)
+            self.assertIn("<p>old bio</p>", html)
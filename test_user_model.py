@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, passwords, User, Message, Follows, Blocks
+from passwords import PasswordHasher, PasswordHasherBusy
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,8 +22,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, session, CURR_USER_KEY
+from current_user import load_snapshot, snapshot_cache
 app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CACHE_TTL'] = 0
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -131,7 +134,73 @@ class UserModelTestCase(TestCase):
             self.u2 = User.query.get(2)
             
             self.assertEqual(self.u1.is_blocking(self.u2), True)
+
+    def test_followed_among(self):
+        """ Can we check follows for a batch of users in one go? """
+
+        self.assertEqual(self.u1.followed_among([self.u2.id]), set())
+        self.assertEqual(self.u1.followed_among([]), set())
+
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.followed_among([self.u1.id, self.u2.id]), {self.u2.id})
+        self.assertEqual(self.u2.followed_among([self.u1.id]), set())
+        self.assertEqual(self.u1.blocked_among([self.u2.id]), set())
+
+    def test_liked_among(self):
+        """ Can we check likes for a page of messages in one go? """
+
+        m1 = Message(text="first", user_id=self.u2.id)
+        m2 = Message(text="second", user_id=self.u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.assertEqual(self.u1.liked_among([m1.id, m2.id]), set())
+        self.assertEqual(self.u1.liked_among([]), set())
+
+        self.u1.likes.append(m2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.liked_among([m1.id, m2.id]), {m2.id})
+        self.assertEqual(self.u2.liked_among([m1.id, m2.id]), set())
+
+    def test_blocker_ids(self):
+        """ Do we only get back the users blocking a given user? """
+
+        self.assertEqual(Blocks.blocker_ids(self.u2.id), set())
+
+        self.u1.blocked_users.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(Blocks.blocker_ids(self.u2.id), {self.u1.id})
+        self.assertEqual(Blocks.blocker_ids(self.u1.id), set())
     
+    def test_user_counters(self):
+        """ Are the follow counters kept up to date and repairable? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+            self.client.post(f"/users/follow/{self.u2.id}")
+
+        self.u1 = User.query.get(1)
+        self.u2 = User.query.get(2)
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+
+        # Counters that drift are repaired by recount
+        self.u1.following_count = 42
+        self.u1.messages_count = 7
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.messages_count, 0)
+        self.assertEqual(self.u2.followers_count, 1)
+
     def test_user_authenticate(self):
         """ Does the User class method 'authenticate' work? """
 
@@ -147,6 +216,64 @@ class UserModelTestCase(TestCase):
         result = User.authenticate("testuser","NOT_VALID_PASS")
         self.assertEqual(bool(result), False)
     
+    def test_user_authenticate_rehash(self):
+        """ Are password hashes upgraded on login when the cost factor changes? """
+
+        old_rounds = passwords.rounds
+        passwords.rounds = 4
+
+        try:
+            self.assertTrue(passwords.needs_rehash(self.u1.password))
+
+            user = User.authenticate("testuser", "HASHED_PASSWORD")
+            db.session.commit()
+
+            self.assertFalse(passwords.needs_rehash(user.password))
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertTrue(User.authenticate("testuser", "HASHED_PASSWORD"))
+
+        finally:
+            passwords.rounds = old_rounds
+
+    def test_password_hash_timeouts(self):
+        """ Are hashes that time out counted apart from completed ones? """
+
+        hasher = PasswordHasher()
+        hasher.workers = 1
+        hasher.timeout = 0.001
+
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.generate_password_hash("HASHED_PASSWORD")
+
+            # The abandoned hash holds its slot until it's really done
+            self.assertEqual(hasher.stats()["in_flight"], 1)
+        finally:
+            hasher._get_pool().shutdown()
+
+        stats = hasher.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["completed"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_user_snapshot_cache(self):
+        """ Is the current user's snapshot cached, and dropped on invalidate? """
+
+        snapshot_cache.clear()
+        snapshot = load_snapshot(self.u1.id, ttl=60)
+        self.assertEqual(snapshot.username, "testuser")
+
+        self.u1.username = "renamed"
+        db.session.commit()
+
+        # Still the cached copy until invalidated
+        self.assertEqual(load_snapshot(self.u1.id, ttl=60).username, "testuser")
+
+        snapshot_cache.invalidate(self.u1.id)
+        self.assertEqual(load_snapshot(self.u1.id, ttl=60).username, "renamed")
+
+        snapshot_cache.clear()
+
     # def test_user_signup: Testing the User Class method was left our
     # as we are using the signup method in our setup; if it did not work
     # none of our other tests would be working.
\ No newline at end of file
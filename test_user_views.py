@@ -21,8 +21,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, session, CURR_USER_KEY
+from fragments import fragment_cache
 app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['USER_CACHE_TTL'] = 0
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -36,6 +38,7 @@ class UserModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
         app.config['SECRET_KEY'] = 'secret'
+        fragment_cache.clear()
         db.create_all()
         User.query.delete()
         Message.query.delete()
@@ -161,6 +164,36 @@ class UserModelTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f"Logout Successful", html)
     
+    def test_user_search(self):
+        """ Can we search for users, best matches first? """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = self.client.get("/users?q=user2")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>@testuser2</p>", html)
+            self.assertNotIn("<p>@testuser1</p>", html)
+
+            # Prefix search, ranked, never returns the viewer
+            resp = self.client.get("/api/users/search?q=TEST&prefix=1")
+            usernames = [user["username"] for user in resp.get_json()["users"]]
+            self.assertEqual(usernames, ["testuser2"])
+
+            # LIKE wildcards in the search term match literally
+            resp = self.client.get("/api/users/search?q=%25")
+            self.assertEqual(resp.get_json()["users"], [])
+
+    def test_user_search_logged_out(self):
+        """ Can anonymous visitors search for users? """
+
+        resp = self.client.get("/users?q=user")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("<p>@testuser1</p>", html)
+        self.assertIn("<p>@testuser2</p>", html)
+
     def test_user_following(self):
         """ Does the following user feature work?"""
         with self.client as c:
@@ -330,4 +363,158 @@ class UserModelTestCase(TestCase):
             # We should no longer be able to view the profile for user 1
             resp = self.client.get(f"/users/{id}")
             html = resp.get_data(as_text=True)
-            self.assertEqual(resp.status_code, 404)
\ No newline at end of file
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_show_conditional_get(self):
+        """ Does the profile page answer 304 until something on it changes? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get(f"/users/{u2_id}")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = self.client.get(f"/users/{u2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            # Following u2 changes the button and u2's follower count
+            self.client.post(f"/users/follow/{u2_id}")
+
+            resp = self.client.get(f"/users/{u2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_user_show_if_modified_since(self):
+        """ Is a date alone never enough for a 304 on a per-viewer page? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get(f"/users/{u2_id}")
+            last_modified = resp.headers["Last-Modified"]
+
+            # Blocking u2 changes the viewer's buttons, but not u2's row
+            self.client.post(f"/users/block/{u2_id}")
+
+            resp = self.client.get(f"/users/{u2_id}",
+                                   headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unblock", resp.get_data(as_text=True))
+
+    def test_own_profile_conditional_get_after_block(self):
+        """ Does blocking someone you don't follow refresh your own profile? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get(f"/users/{u1_id}")
+            etag = resp.headers["ETag"]
+            self.assertIn(f'/users/{u1_id}/blocked-users">0</a>', resp.get_data(as_text=True))
+
+            self.client.post(f"/users/block/{u2_id}")
+
+            resp = self.client.get(f"/users/{u1_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'/users/{u1_id}/blocked-users">1</a>', resp.get_data(as_text=True))
+
+    def test_static_files_cached(self):
+        """ Are versioned static URLs cacheable for good, and others not? """
+        resp = self.client.get("/login")
+        html = resp.get_data(as_text=True)
+        url = html.split('<script src="')[-1].split('"')[0]
+        self.assertTrue(url.startswith("/static/main.js?v="))
+
+        resp = self.client.get(url)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+
+        resp = self.client.get("/static/main.js")
+        self.assertEqual(resp.headers["Cache-Control"], "public, no-cache")
+
+    def test_api_follow_and_block(self):
+        """ Are the JSON follow/block toggles idempotent, with fresh counts? """
+        u1_id = self.u1.id
+        u2_id = self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            for _ in range(2):
+                resp = self.client.put(f"/api/users/{u2_id}/follow")
+                self.assertEqual(resp.get_json(), {
+                    "following": True,
+                    "user": {"followers_count": 1, "following_count": 0},
+                    "me": {"followers_count": 0, "following_count": 1},
+                })
+
+            # Blocking ends the follow
+            for _ in range(2):
+                resp = self.client.put(f"/api/users/{u2_id}/block")
+                data = resp.get_json()
+                self.assertEqual(data["blocking"], True)
+                self.assertEqual(data["following"], False)
+                self.assertEqual(data["user"]["followers_count"], 0)
+
+            resp = self.client.delete(f"/api/users/{u2_id}/block")
+            self.assertEqual(resp.get_json()["blocking"], False)
+            self.assertEqual(User.query.get(u1_id).blocked_users, [])
+
+            resp = self.client.put(f"/api/users/{u1_id}/follow")
+            self.assertEqual(resp.status_code, 403)
+
+        resp = app.test_client().put(f"/api/users/{u2_id}/follow")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_followers_paged(self):
+        """ Are long follower lists paged, with the viewer's follow state? """
+        u1_id = self.u1.id
+
+        fans = [User(email=f"fan{i}@test.com", username=f"fan{i}",
+                     password="HASHED_PASSWORD") for i in range(110)]
+        db.session.add_all(fans)
+        db.session.commit()
+        fan_ids = [fan.id for fan in fans]
+
+        db.session.add_all([Follows(user_being_followed_id=u1_id, user_following_id=fan_id)
+                            for fan_id in fan_ids])
+        # u1 follows back the newest fan and one on the second page
+        db.session.add_all([Follows(user_being_followed_id=fan_id, user_following_id=u1_id)
+                            for fan_id in (fan_ids[-1], fan_ids[0])])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = self.client.get(f"/users/{u1_id}/followers")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count('class="card-bio"'), 100)
+            self.assertIn("<p>@fan109</p>", html)
+            self.assertNotIn("<p>@fan9</p>", html)
+            self.assertEqual(html.count("stop-following"), 1)
+            self.assertIn(f"/users/{u1_id}/followers?before={fan_ids[10]}", html)
+
+            resp = self.client.get(f"/users/{u1_id}/followers?before={fan_ids[10]}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('class="card-bio"'), 10)
+            self.assertIn("<p>@fan0</p>", html)
+            self.assertEqual(html.count("stop-following"), 1)
+            self.assertNotIn("?before=", html)
+
+            resp = self.client.get(f"/users/{u1_id}/following")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('class="card-bio"'), 2)
+            self.assertEqual(html.count("stop-following"), 2)